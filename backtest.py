@@ -0,0 +1,73 @@
+#!/usr/bin/env python2.7
+""" Backtest trades over downloaded aggregate trades.
+
+python backtest.py download LTC BTC 2018-01-01 2018-03-01
+python backtest.py run trades.json --intervals 1 5 10 30 --deltas 0.02 0.05
+
+trades.json holds trades the way /trade stores them, e.g.
+{"1": {"pair": ["LTC", "BTC"], "type": "TRAILING_STOP_LOSS", "quantity": 1, "threshold": 0.015, "delta": 0.05}}
+"""
+import argparse
+import calendar
+import datetime
+import json
+import os
+
+from backtest_util import download_ticks, load_ticks, sweep
+from binance_util import BinanceClient
+
+kTicksDir = 'data/ticks'
+
+def ticks_path(pair):
+	return os.path.join(kTicksDir, '%s_%s.ticks' % pair)
+
+def to_ms(date):
+	return calendar.timegm(datetime.datetime.strptime(date, '%Y-%m-%d').timetuple()) * 1000
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='KZBot backtest')
+	commands = parser.add_subparsers(dest='command')
+	download = commands.add_parser('download', help='append the aggregate trades of a pair to its tick file')
+	download.add_argument('coin')
+	download.add_argument('market')
+	download.add_argument('start', help='YYYY-MM-DD')
+	download.add_argument('end', help='YYYY-MM-DD')
+	run = commands.add_parser('run', help='run trades over the downloaded tick files')
+	run.add_argument('trades', help='json file of {key: trade}')
+	run.add_argument('--intervals', type=float, nargs='+', default=[10], help='seconds between checks')
+	run.add_argument('--deltas', type=float, nargs='+', default=[None], help='trailing stop deltas to try')
+	run.add_argument('--filters', action='store_true', help='apply the min lot size and price step of the exchange')
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	if args.command == 'download':
+		if not os.path.exists(kTicksDir):
+			os.makedirs(kTicksDir)
+		pair = (args.coin.upper(), args.market.upper())
+		count = download_ticks(BinanceClient('', ''), pair, to_ms(args.start), to_ms(args.end), ticks_path(pair))
+		print 'Downloaded %d ticks of %s.' % (count, '/'.join(pair))
+		return
+
+	with open(args.trades) as f:
+		trades = json.load(f)
+	pairs = set(tuple(x['pair']) for x in trades.itervalues())
+	ticks = {pair: load_ticks(ticks_path(pair)) for pair in pairs if os.path.exists(ticks_path(pair))}
+	for pair in pairs - set(ticks):
+		print 'No ticks for %s, download them first.' % '/'.join(pair)
+	filters = None
+	if args.filters:
+		client = BinanceClient('', '')
+		filters = {}
+		for pair in ticks:
+			symbol_info = client.get_symbol_info(pair)
+			filters[pair] = (client.get_min_lot_size(symbol_info), client.get_price_step(symbol_info))
+
+	results = sweep(ticks, trades, args.intervals, args.deltas, filters=filters)
+	names = results.values()[0].keys()
+	print '%-10s%-10s' % ('interval', 'delta') + ''.join('%18s' % x for x in names)
+	for (interval, delta), summary in results.iteritems():
+		print '%-10s%-10s' % (interval, delta) + ''.join('%18.6g' % summary[x] for x in names)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,167 @@
+import collections
+import os
+
+import numpy as np
+
+from constants import TRADE_TYPE, kRunInterval
+from trade_book import TradeBook
+from window_util import MarketWindow
+
+# Record of a tick file, one per aggregate trade in id order.
+TICK_DTYPE = np.dtype([('id', '<i8'), ('time', '<i8'), ('price', '<f8'), ('quantity', '<f8')])
+
+def append_ticks(path, trades):
+	""" Append an aggTrades response to the tick file at path.
+	"""
+	ticks = np.empty(len(trades), dtype=TICK_DTYPE)
+	ticks['id'] = [x['a'] for x in trades]
+	ticks['time'] = [x['T'] for x in trades]
+	ticks['price'] = [x['p'] for x in trades]
+	ticks['quantity'] = [x['q'] for x in trades]
+	with open(path, 'ab') as f:
+		ticks.tofile(f)
+
+def load_ticks(path):
+	""" The ticks of path, memory mapped so only the pages a backtest reads are loaded.
+	"""
+	if not os.path.getsize(path):
+		return np.empty(0, dtype=TICK_DTYPE)
+	return np.memmap(path, dtype=TICK_DTYPE, mode='r')
+
+def download_ticks(client, pair, start_time, end_time, path):
+	""" Append the aggregate trades of pair between start_time and end_time (ms) to path, returns how many.
+
+	Continues after the last tick already in the file, so an interrupted download can be resumed.
+	Raises when the file is left without any tick, e.g. the pair only listed after end_time.
+	"""
+	symbol = pair[0] + pair[1]
+	ticks = load_ticks(path) if os.path.exists(path) else np.empty(0, dtype=TICK_DTYPE)
+	count = 0
+	if len(ticks):
+		trades = client.get_aggregate_trades(symbol=symbol, fromId=int(ticks['id'][-1]) + 1, limit=1000)
+	else:
+		# startTime and endTime may be at most an hour apart, an hour at a time up to the first trade, e.g.
+		# past the listing or a maintenance of the exchange. From there on it pages by id.
+		trades = []
+		while not trades and start_time <= end_time:
+			trades = client.get_aggregate_trades(symbol=symbol, startTime=start_time, endTime=min(start_time + 60 * 60 * 1000, end_time))
+			start_time += 60 * 60 * 1000
+	while trades:
+		done = trades[-1]['T'] > end_time
+		trades = [x for x in trades if x['T'] <= end_time]
+		if trades:
+			append_ticks(path, trades)
+			count += len(trades)
+		if done or not trades:
+			break
+		trades = client.get_aggregate_trades(symbol=symbol, fromId=trades[-1]['a'] + 1, limit=1000)
+	if not count and not len(ticks):
+		raise Exception('No trades of %s to download' % '/'.join(pair))
+	return count
+
+class Fill(collections.namedtuple('Fill', 'time key type side quantity threshold price slippage')):
+	""" A fired trade. side and quantity are None for alerts.
+
+	price: of the tick right after the loop that fired it, where a market order would have filled.
+	slippage: relative gain of price over the threshold, negative when it filled worse than the threshold.
+	"""
+	__slots__ = ()
+
+def backtest(ticks, trades, interval=kRunInterval, window=2 * kRunInterval, filter_threshold=0.8, filters=None, balances=None):
+	""" Run trades over recorded ticks the way MyWorker._run_loop would, checking every pair every interval seconds.
+
+	ticks: {pair: load_ticks(...)}, e.g. {('LTC', 'BTC'): load_ticks('data/ticks/LTCBTC.ticks')}.
+	trades: {key: trade} as stored in trades_db.
+	filters: {pair: (min lot size, price step)}, no minimum lot and no price step by default.
+	balances: {asset: free quantity} at the start, unlimited by default. Orders move them.
+
+	Returns (fills, open trades at the end).
+	"""
+	filters = filters or {}
+	balances = collections.defaultdict(lambda: float('inf'), balances or {})
+	trades = {key: dict(trade) for key, trade in trades.iteritems() if tuple(trade['pair']) in ticks}
+	book = TradeBook(trades.iteritems())
+	window_ms = int(window * 1000)
+	columns = {pair: (x['time'], x['price'], x['quantity']) for pair, x in ticks.iteritems() if len(x)}
+	if not columns:
+		return [], trades
+	start = int(min(x[0][0] for x in columns.itervalues()))
+	end = int(max(x[0][-1] for x in columns.itervalues()))
+	fills = []
+	for now in xrange(start + window_ms, end + 1, int(interval * 1000)):
+		if not len(book):
+			break
+		markets = {}
+		fill_prices = {}
+		for pair, (times, prices, quantities) in columns.iteritems():
+			first = np.searchsorted(times, now - window_ms)
+			last = np.searchsorted(times, now, side='right')
+			if not last:
+				continue
+			market_window = MarketWindow(prices[first:last], filter_threshold, quantities[first:last])
+			current_price = market_window.last or float(prices[last - 1])
+			min_q, price_step = filters.get(pair, (0, 0))
+			markets[pair] = (current_price, market_window.max() or current_price, market_window.min() or current_price, balances[pair[0]], min_q, price_step)
+			fill_prices[pair] = float(prices[last]) if last < len(prices) else None
+
+		moved, fired, _ = book.evaluate(markets)
+		for key, threshold in moved:
+			trades[key]['threshold'] = threshold
+			book.update(key, trades[key])
+		for key, quantity in fired:
+			trade = trades[key]
+			pair = tuple(trade['pair'])
+			if quantity is None:
+				fills.append(Fill(now, key, trade['type'], None, None, trade['threshold'], markets[pair][0], None))
+			else:
+				price = fill_prices[pair]
+				# The history ended before the order could fill.
+				if price is None:
+					continue
+				if trade['type'] == TRADE_TYPE.BUY_BELOW_AT_MARKET:
+					side, slippage = 'BUY', trade['threshold'] / price - 1
+					balances[pair[0]] += quantity
+					balances[pair[1]] -= quantity * price
+				else:
+					side, slippage = 'SELL', price / trade['threshold'] - 1
+					balances[pair[0]] -= quantity
+					balances[pair[1]] += quantity * price
+				fills.append(Fill(now, key, trade['type'], side, quantity, trade['threshold'], price, slippage))
+			book.remove(key)
+			del trades[key]
+	return fills, trades
+
+def summarize(fills, trades):
+	""" Totals of a backtest: fills per side, slippage and the quote currency the orders gained or spent.
+	"""
+	orders = [x for x in fills if x.side is not None]
+	slippage = np.array([x.slippage for x in orders])
+	return collections.OrderedDict([
+		('alerts', len(fills) - len(orders)),
+		('buys', sum(1 for x in orders if x.side == 'BUY')),
+		('sells', sum(1 for x in orders if x.side == 'SELL')),
+		('open', len(trades)),
+		('slippage mean %', slippage.mean() * 100 if len(slippage) else float('nan')),
+		('slippage worst %', slippage.min() * 100 if len(slippage) else float('nan')),
+		('quote flow', sum(x.quantity * x.price * (1 if x.side == 'SELL' else -1) for x in orders)),
+	])
+
+def sweep(ticks, trades, intervals, deltas=(None,), **kwargs):
+	""" summarize() of a backtest per (interval, trailing delta), e.g. to tune kRunInterval.
+
+	deltas: trailing stop deltas to try instead of the ones of the trades, None keeps them. A
+	replaced delta also resets the stop to that far below the first price, like create_trade does.
+	"""
+	results = collections.OrderedDict()
+	for delta in deltas:
+		trial = trades
+		if delta is not None:
+			trial = {}
+			for key, trade in trades.iteritems():
+				pair = tuple(trade['pair'])
+				if trade['type'] == TRADE_TYPE.TRAILING_STOP_LOSS and pair in ticks and len(ticks[pair]):
+					trade = dict(trade, delta=delta, threshold=float(ticks[pair]['price'][0]) * (1 - delta))
+				trial[key] = trade
+		for interval in intervals:
+			results[(interval, delta)] = summarize(*backtest(ticks, trial, interval, **kwargs))
+	return results
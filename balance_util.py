@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+
+from autobahn.twisted.websocket import connectWS
+from binance.websockets import BinanceSocketManager, BinanceClientFactory, BinanceClientProtocol
+from twisted.internet import reactor, ssl, threads
+
+from constants import kStreamUrl, kBalanceReconcileInterval, kRunInterval, kListenKeyKeepalive
+import metrics_util
+
+_EMPTY = {'free': 0.0, 'locked': 0.0}
+
+def _differs(a, b, tolerance=1e-8):
+	a, b = a or _EMPTY, b or _EMPTY
+	return abs(a['free'] - b['free']) > tolerance or abs(a['locked'] - b['locked']) > tolerance
+
+class BalanceCache(object):
+	""" Balances of the account, seeded from get_account and then kept current by the user data stream.
+
+	outboundAccountInfo events replace the balances they list. executionReport fills are applied
+	right away so the next loop sees them, unless an account update already covers them. A
+	reconciliation poll every kBalanceReconcileInterval seconds corrects any drift.
+
+	The socket is pinged every kRunInterval and dropped when a pong doesn't come back in time. While
+	it isn't connected the balances are polled every kRunInterval as without the stream, and once
+	more when it is back, for the events missed meanwhile. The listenKey is kept alive from
+	get_balances. Thread safe, twisted calls are made on the reactor thread.
+	"""
+	def __init__(self, client, url=kStreamUrl, reconcile_interval=kBalanceReconcileInterval):
+		self._c = client
+		# Only runs the reactor, the socket is our own so its connection can be watched.
+		self._manager = BinanceSocketManager(client)
+		self._manager.setDaemon(True)
+		self._url = url
+		self._reconcile_interval = reconcile_interval
+		self._lock = threading.Lock()
+		self._balances = None
+		self._pairs = None
+		self._account_time = 0
+		self._events = 0
+		self._reconciled_at = None
+		self._listen_key = None
+		self._kept_alive_at = None
+		self._connector = None
+		self._was_connected = False
+
+	def start(self):
+		self._manager.start()
+		reactor.callFromThread(self._connect)
+
+	def stop(self):
+		""" Close the socket and the listenKey, the socket manager doesn't know about either.
+		"""
+		reactor.callFromThread(self._disconnect)
+		if self._listen_key is not None:
+			try:
+				self._c.stream_close(listenKey=self._listen_key)
+			except Exception as e:
+				logging.error('Failed to close the user data stream: %s', e)
+			self._listen_key = None
+
+	def is_connected(self):
+		return self._connector is not None and self._connector.state == 'connected'
+
+	def get_balances(self, symbols=None):
+		""" Like BinanceClient.get_balances, polls get_account only when a reconciliation is due.
+		"""
+		connected = self.is_connected()
+		now = time.time()
+		if (self._reconciled_at is None or now - self._reconciled_at >= self._reconcile_interval
+				or (not connected and now - self._reconciled_at >= kRunInterval) or (connected and not self._was_connected)):
+			self.reconcile()
+		self._was_connected = connected
+		if self._listen_key is not None and now - self._kept_alive_at >= kListenKeyKeepalive:
+			self._keepalive()
+		elif not connected and self._connector is not None and self._connector.factory.retries > self._connector.factory.maxRetries:
+			logging.warning('The user data stream gave up reconnecting, opening a new one')
+			self._connector = None
+			reactor.callFromThread(self._connect)
+		with self._lock:
+			return {x: dict(y) for x, y in self._balances.iteritems() if symbols is None or x in symbols}
+
+	def reconcile(self):
+		""" Replace the cached balances with a fresh get_account, logging any drift.
+		"""
+		with self._lock:
+			events = self._events
+		balances = self._c.get_balances()
+		with self._lock:
+			# A stream event came in while the request was out, the response may be older than it.
+			if self._balances is not None and self._events != events:
+				self._reconciled_at = time.time()
+				return
+			if self._balances is not None:
+				drift = [x for x in set(balances) | set(self._balances) if _differs(self._balances.get(x), balances.get(x))]
+				if drift:
+					logging.warning('Balance drift on %s', ' '.join(sorted(drift)))
+					metrics_util.inc('balance_drift_total', len(drift))
+			self._balances = balances
+			self._reconciled_at = time.time()
+
+	def _keepalive(self):
+		""" Extend the listenKey, Binance answers with a new one once it expired.
+		"""
+		try:
+			listen_key = self._c.stream_get_listen_key()
+		except Exception as e:
+			logging.error('Failed to keep the user data stream alive: %s', e)
+			return
+		self._kept_alive_at = time.time()
+		if listen_key != self._listen_key:
+			reactor.callFromThread(self._open, listen_key)
+
+	def _connect(self):
+		# A REST request, it mustn't hold up the reactor.
+		d = threads.deferToThread(self._c.stream_get_listen_key)
+		d.addCallbacks(self._open, lambda failure: logging.error('Failed to start the user data stream: %s', failure.getErrorMessage()))
+
+	def _open(self, listen_key):
+		self._disconnect()
+		self._listen_key = listen_key
+		self._kept_alive_at = time.time()
+		factory = BinanceClientFactory(self._url + 'ws/' + listen_key)
+		factory.protocol = BinanceClientProtocol
+		factory.callback = self._on_message
+		# A socket that died quietly stops answering pings and is dropped, then reconnected.
+		factory.setProtocolOptions(autoPingInterval=kRunInterval, autoPingTimeout=kRunInterval)
+		self._connector = connectWS(factory, ssl.ClientContextFactory())
+
+	def _disconnect(self):
+		connector, self._connector = self._connector, None
+		if connector is not None:
+			connector.factory.stopTrying()
+			connector.disconnect()
+
+	def _get_pairs(self):
+		if self._pairs is None:
+			self._pairs = self._c.get_symbol_pairs()
+		return self._pairs
+
+	def _on_message(self, msg):
+		if msg.get('e') == 'outboundAccountInfo':
+			self._on_account_info(msg)
+		elif msg.get('e') == 'executionReport' and msg.get('x') == 'TRADE':
+			self._on_fill(msg)
+
+	def _on_account_info(self, msg):
+		with self._lock:
+			if self._balances is None or msg['u'] < self._account_time:
+				return
+			for balance in msg['B']:
+				self._balances[balance['a']] = {'free': float(balance['f']), 'locked': float(balance['l'])}
+			self._account_time = msg['u']
+			self._events += 1
+
+	def _on_fill(self, msg):
+		pair = self._get_pairs().get(msg['s'])
+		if pair is None:
+			return
+		base, quote = pair
+		quantity = float(msg['l'])
+		cost = quantity * float(msg['L'])
+		if msg['S'] == 'SELL':
+			quantity, cost = -quantity, -cost
+		with self._lock:
+			# The account update of this fill was applied already.
+			if self._balances is None or msg['T'] <= self._account_time:
+				return
+			for asset, change in ((base, quantity), (quote, -cost), (msg.get('N'), -float(msg.get('n') or 0))):
+				if asset is None or not change:
+					continue
+				balance = self._balances.setdefault(asset, {'free': 0.0, 'locked': 0.0})
+				balance['free'] += change
+			self._events += 1
@@ -0,0 +1,169 @@
+#!/usr/bin/env python2.7
+""" Replays a synthetic (or recorded) market through MyWorker and reports what every loop costs.
+
+python bench.py --trades 10 100 1000 --pairs 50
+python bench.py --trades 1000 --tenants 20
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The bot keeps its state in data/ of the working directory, never touch the real one.
+_BENCH_DIR = tempfile.mkdtemp(prefix='kzbot-bench-')
+os.mkdir(os.path.join(_BENCH_DIR, 'data'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(_BENCH_DIR)
+
+import numpy as np
+
+import dal
+from constants import TRADE_TYPE, kRunInterval
+from my_worker import MyWorker
+from replay_util import ReplayClient, SimClock, synthetic_market
+from threading_util import state_lock
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='KZBot loop benchmark')
+	parser.add_argument('--trades', type=int, nargs='+', default=[10, 100, 1000], help='open trades of every run')
+	parser.add_argument('--pairs', type=int, default=50, help='pairs of the synthetic market')
+	parser.add_argument('--tenants', type=int, default=1, help='users the trades are spread over')
+	parser.add_argument('--duration', type=int, default=300, help='simulated seconds of every run')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--recording', help='replay a RecordingClient file instead of a synthetic market')
+	return parser.parse_args()
+
+def make_trades(count, prices, pairs, random):
+	""" count trades on random pairs with thresholds a few percent away from the current price.
+	"""
+	symbols = sorted(x for x in prices if x in pairs)
+	trades = []
+	for _ in xrange(count):
+		symbol = symbols[random.randint(len(symbols))]
+		trade_type = TRADE_TYPE.ALL[random.randint(len(TRADE_TYPE.ALL))]
+		offset = random.uniform(0.001, 0.02)
+		above = trade_type in (TRADE_TYPE.SELL_ABOVE_AT_MARKET, TRADE_TYPE.ALERT_ABOVE)
+		trade = {
+			'pair': pairs[symbol],
+			'type': trade_type,
+			'threshold': prices[symbol] * (1 + offset if above else 1 - offset),
+		}
+		if not trade_type.startswith('ALERT'):
+			trade['quantity'] = 1.0
+		if trade_type == TRADE_TYPE.TRAILING_STOP_LOSS:
+			trade['delta'] = offset
+		trades.append(trade)
+	return trades
+
+def first_cross(series, trade, since):
+	""" Time in ms the market first crossed the threshold of trade after since, None if it never did.
+	"""
+	times, prices = series[''.join(trade['pair'])]
+	mask = times >= since
+	if trade['type'] in (TRADE_TYPE.SELL_ABOVE_AT_MARKET, TRADE_TYPE.ALERT_ABOVE):
+		mask &= prices > trade['threshold']
+	else:
+		mask &= prices < trade['threshold']
+	crossed = np.flatnonzero(mask)
+	return int(times[crossed[0]]) if len(crossed) else None
+
+def clear_trades(tenants):
+	with state_lock.write():
+		for tenant in tenants:
+			for key in list(tenant.trades_db.keys()):
+				tenant.delete_trade(key)
+			tenant.trades_db.sync()
+
+def get_open_trades(tenants):
+	""" {(tenant, key): trade} over all the tenants.
+	"""
+	return {(i, key): trade for i, tenant in enumerate(tenants) for key, trade in tenant.trades_db.iteritems()}
+
+def run(records, series, trade_count, start, duration, seed, tenant_count):
+	clock = SimClock(start)
+	client = ReplayClient(records, clock)
+	prices = client.get_prices()
+	# The other tenants trade on the same replayed account.
+	tenants = [dal.get_owner()] + [dal.add_tenant(i) for i in xrange(1, tenant_count)]
+	for tenant in tenants[1:]:
+		tenant.config.update({'chat_id': 0, 'api_key': 'bench', 'secret': 'bench'})
+	clear_trades(tenants)
+	trades = make_trades(trade_count, prices, client.get_symbol_pairs(), np.random.RandomState(seed))
+	for i, tenant in enumerate(tenants):
+		tenant.save_trades(trades[i::tenant_count])
+	trades = get_open_trades(tenants)
+
+	worker = MyWorker(client, use_streams=False, clock=clock, client_factory=lambda api_key, secret, user_id: client)
+	loop_times = []
+	calls = []
+	weights = []
+	fired_at = {}
+	while clock() < start + duration:
+		calls_before, weight_before = sum(client.calls.values()), client.weight
+		began = time.time()
+		next_run = worker.run_once()
+		loop_times.append(time.time() - began)
+		calls.append(sum(client.calls.values()) - calls_before)
+		weights.append(client.weight - weight_before)
+		for key in set(trades) - set(fired_at) - set(get_open_trades(tenants)):
+			fired_at[key] = clock()
+		clock.set(max(next_run, clock() + 0.1))
+
+	# How long after the market crossed its threshold each fired trade was acted on, trailing stops excluded.
+	latencies = []
+	for key, at in fired_at.iteritems():
+		trade = trades[key]
+		if trade['type'] == TRADE_TYPE.TRAILING_STOP_LOSS or series is None:
+			continue
+		crossed = first_cross(series, trade, int(start * 1000))
+		if crossed is not None:
+			latencies.append(at - crossed / 1000.0)
+	loop_times = np.array(loop_times) * 1000
+	result = collections.OrderedDict([
+		('trades', trade_count),
+		('tenants', tenant_count),
+		('loops', len(loop_times)),
+		('loop ms mean', loop_times.mean()),
+		('loop ms p50', np.percentile(loop_times, 50)),
+		('loop ms p95', np.percentile(loop_times, 95)),
+		('loop ms max', loop_times.max()),
+		('calls/loop', np.mean(calls)),
+		('weight/loop', np.mean(weights)),
+		('weight/min', client.weight * 60.0 / duration),
+		('fired', len(fired_at)),
+		('orders', len(client.orders)),
+		('latency s p50', np.percentile(latencies, 50) if latencies else float('nan')),
+		('latency s max', max(latencies) if latencies else float('nan')),
+	])
+	return result
+
+def main():
+	args = parse_args()
+	# Notifications queue up unsent instead of logging an error each.
+	dal.config['chat_id'] = 0
+	dal.config['owner_id'] = 0
+	if args.recording:
+		with open(args.recording) as f:
+			records = [json.loads(line) for line in f if line.strip()]
+		series = None
+		start = min(x['time'] for x in records) / 1000.0
+		duration = max(x['time'] for x in records) / 1000.0 - start
+	else:
+		pairs = [('C%03d' % i, 'BTC') for i in xrange(args.pairs)]
+		# Leave one window of history before the first loop.
+		start = 1500000000.0
+		records, series = synthetic_market(pairs, start - 2 * kRunInterval, args.duration + 2 * kRunInterval, seed=args.seed)
+		duration = args.duration
+	try:
+		results = [run(records, series, x, start, duration, args.seed, args.tenants) for x in args.trades]
+	finally:
+		shutil.rmtree(_BENCH_DIR, ignore_errors=True)
+	for name in results[0]:
+		print '%-14s' % name + ''.join('%12.2f' % x[name] if isinstance(x[name], float) else '%12d' % x[name] for x in results)
+
+if __name__ == '__main__':
+	main()
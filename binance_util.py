@@ -1,22 +1,82 @@
 from binance.client import Client as _Client
-import math
-from numpy import median
+from binance.exceptions import BinanceAPIException as _BinanceAPIException
+from constants import kExchangeInfoTTL, kHttpPoolSize, kRequestTimeout, kRequestWeightLimit, kMaxAggTradePages
+from requests.adapters import HTTPAdapter as _HTTPAdapter
+import collections
+from decimal import Decimal, ROUND_DOWN
+import threading
+import time
+import metrics_util
+
+# Binance error code for orders rejected by a symbol filter, e.g. "Filter failure: LOT_SIZE".
+kFilterFailureCode = -1013
+
+# Most aggTrades one request may return.
+kAggTradesLimit = 500
+
+# Request weight of the endpoints we use, everything else counts as 1.
+_REQUEST_WEIGHTS = {
+	'account': 5,
+	'allOrders': 5,
+	'myTrades': 5,
+	'historicalTrades': 5,
+	'ticker/allPrices': 2,
+	'ticker/allBookTickers': 2,
+}
+
+def get_request_weight(path):
+	return _REQUEST_WEIGHTS.get(path, 1)
+
+class _TimeoutAdapter(_HTTPAdapter):
+	""" Keep-alive connection pool that applies our own (connect, read) timeouts to every request.
+	"""
+	def __init__(self, timeout, **kwargs):
+		_HTTPAdapter.__init__(self, **kwargs)
+		self._timeout = timeout
+
+	def send(self, request, **kwargs):
+		kwargs['timeout'] = self._timeout
+		return _HTTPAdapter.send(self, request, **kwargs)
 
 class BinanceClient(_Client):
 	def __init__(self, api_key, api_secret):
 		_Client.__init__(self, api_key, api_secret)
 
+	def _request_api(self, method, path, *args, **kwargs):
+		_glb_weight_budget.acquire(get_request_weight(path))
+		started = time.time()
+		try:
+			return _Client._request_api(self, method, path, *args, **kwargs)
+		except Exception as e:
+			metrics_util.inc('request_errors_total', endpoint=path, error=e.code if isinstance(e, _BinanceAPIException) else type(e).__name__)
+			raise
+		finally:
+			metrics_util.observe('request_seconds', time.time() - started, endpoint=path)
+
+	def _init_session(self):
+		session = _Client._init_session(self)
+		adapter = _TimeoutAdapter(kRequestTimeout, pool_connections=1, pool_maxsize=kHttpPoolSize)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		return session
+
 	def get_symbol_info(self, pair):
-		info = _Client.get_symbol_info(self, ''.join(pair))
-		info['filters'] = {x['filterType']: x for x in info['filters']}
-		return info
+		return _glb_symbol_info.get(self, ''.join(pair))
+
+	def refresh_symbol_info(self):
+		_glb_symbol_info.refresh(self)
+
+	def get_symbol_pairs(self):
+		""" {symbol: (base asset, quote asset)} of every symbol on the exchange, e.g. {'LTCBTC': ('LTC', 'BTC')}.
+		"""
+		return {x: (y['baseAsset'], y['quoteAsset']) for x, y in _glb_symbol_info.get_all(self).iteritems()}
 
-	def get_balances(self, symbols):
+	def get_balances(self, symbols=None):
 		"""
-		symbols: set of symbols to get balances for, e.g. {'BTC', 'LTC'}.
+		symbols: set of symbols to get balances for, e.g. {'BTC', 'LTC'}, all balances if None.
 		"""
 		account_info = _Client.get_account(self)
-		return {x['asset']: {'free': float(x['free']), 'locked': float(x['locked'])} for x in account_info['balances'] if x['asset'] in symbols}
+		return {x['asset']: {'free': float(x['free']), 'locked': float(x['locked'])} for x in account_info['balances'] if symbols is None or x['asset'] in symbols}
 
 	def get_prices(self, pairs=None):
 		"""
@@ -31,42 +91,56 @@ class BinanceClient(_Client):
 	def get_server_time(self):
 		return _Client.get_server_time(self)['serverTime']
 
-	def get_recent_price(self, pair, server_time, window, do_max=True, filter_threshold=1.0):
-		# TODO: move filtering to util function, not part of binance API
+	def update_trade_buffer(self, buffer, pair, server_time, window):
+		""" Bring buffer up to date, downloading only the aggTrades newer than its last one.
+
+		An empty buffer gets the last window seconds by time range, any other pages on from its newest
+		trade however old it is: a single request while fewer than kAggTradesLimit trades happened since,
+		up to kMaxAggTradePages on a busy pair. A time range only returns its first kAggTradesLimit trades,
+		so a full one is paged on from its last trade the same way.
+
+		Returns whether the buffer holds every trade up to server_time. When kMaxAggTradePages pages don't
+		get there the newest kAggTradesLimit trades are appended on top, leaving a hole before them.
+		"""
 		symbol = pair[0] + pair[1]
-		start_time = server_time - window * 1000
-		end_time = server_time
-		trades = self.get_aggregate_trades(symbol=symbol, startTime=start_time, endTime=end_time)
-		if len(trades) == 0:
-	#		logging.debug('No trades for %s', pair)
-			return None
-		prices = [float(trade['p']) for trade in trades]
-		# Filter out outliers
-		if filter_threshold < 1.0:
-			prices = filter_prices(prices, filter_threshold)
-		if do_max:
-			recent_price = max(prices)
-		else:
-			recent_price = min(prices)
-
-	#	logging.debug('Recent price for %s is %s', pair, recent_price)
-		return recent_price
+		if buffer.last_id is None:
+			trades = self.get_aggregate_trades(symbol=symbol, startTime=server_time - window * 1000, endTime=server_time)
+			buffer.extend(trades)
+			if len(trades) < kAggTradesLimit:
+				return True
+		for _ in xrange(kMaxAggTradePages):
+			trades = self.get_aggregate_trades(symbol=symbol, fromId=buffer.last_id + 1, limit=kAggTradesLimit)
+			buffer.extend(trades)
+			if len(trades) < kAggTradesLimit:
+				return True
+		buffer.extend(self.get_aggregate_trades(symbol=symbol, limit=kAggTradesLimit))
+		return False
 
 	def create_order(self, pair, side, type, quantity):
-		return _Client.create_order(
-			self,
-			symbol=pair[0] + pair[1],
-			side=side,
-			type=type,
-			quantity=quantity)
+		try:
+			return _Client.create_order(
+				self,
+				symbol=pair[0] + pair[1],
+				side=side,
+				type=type,
+				quantity=quantity)
+		except _BinanceAPIException as e:
+			if e.code == kFilterFailureCode:
+				_glb_symbol_info.invalidate()
+			raise
 
 	def create_test_order(self, pair, side, type, quantity):
-		return _Client.create_test_order(
-			self,
-			symbol=pair[0] + pair[1],
-			side=side,
-			type=type,
-			quantity=quantity)
+		try:
+			return _Client.create_test_order(
+				self,
+				symbol=pair[0] + pair[1],
+				side=side,
+				type=type,
+				quantity=quantity)
+		except _BinanceAPIException as e:
+			if e.code == kFilterFailureCode:
+				_glb_symbol_info.invalidate()
+			raise
 
 	@staticmethod
 	def get_min_lot_size(symbol_info):
@@ -78,6 +152,21 @@ class BinanceClient(_Client):
 	def get_lot_size_step(symbol_info):
 		return float(symbol_info['filters']['LOT_SIZE']['stepSize'])
 	@staticmethod
+	def get_order_quantity(symbol_info, quantity):
+		""" quantity rounded down to the lot step and capped at the max lot, as an exact decimal string.
+
+		None if that is below the min lot, so the order would be rejected by the LOT_SIZE filter.
+		"""
+		lot_size = symbol_info['filters']['LOT_SIZE']
+		step = Decimal(lot_size['stepSize']).normalize()
+		quantity = min(Decimal(repr(float(quantity))), Decimal(lot_size['maxQty']))
+		if step:
+			# Keep the decimals of the step only, '1E+1' steps still give plain integers.
+			quantity = (quantity // step * step).quantize(Decimal(1).scaleb(min(step.as_tuple().exponent, 0)), rounding=ROUND_DOWN)
+		if quantity < Decimal(lot_size['minQty']) or quantity <= 0:
+			return None
+		return str(quantity)
+	@staticmethod
 	def get_max_price(symbol_info):
 		return float(symbol_info['filters']['PRICE_FILTER']['maxPrice'])
 	@staticmethod
@@ -87,10 +176,130 @@ class BinanceClient(_Client):
 	def get_price_step(symbol_info):
 		return float(symbol_info['filters']['PRICE_FILTER']['tickSize'])
 
-def filter_prices(prices, threshold):
-	""" Keep threshold percent of the prices based on distance from the median.
+class RequestWeightBudget(object):
+	""" Client side account of the request weight Binance allows per IP and minute.
+
+	acquire() blocks until the weight fits in what was spent over the last period seconds,
+	so bursts of concurrent requests can never get the IP banned.
+	"""
+	def __init__(self, limit=kRequestWeightLimit, period=60):
+		self._limit = limit
+		self._period = period
+		self._spent = collections.deque()
+		self._used = 0
+		self.total = 0
+		self._lock = threading.Lock()
+
+	def _expire(self, now):
+		while self._spent and self._spent[0][0] <= now - self._period:
+			self._used -= self._spent.popleft()[1]
+
+	def acquire(self, weight):
+		while True:
+			with self._lock:
+				now = time.time()
+				self._expire(now)
+				if self._used + weight <= self._limit or not self._spent:
+					self._spent.append((now, weight))
+					self._used += weight
+					self.total += weight
+					return
+				wait = self._spent[0][0] + self._period - now
+			time.sleep(wait)
+
+	def used(self):
+		""" Weight spent over the last period seconds.
+		"""
+		with self._lock:
+			self._expire(time.time())
+			return self._used
+
+	@property
+	def limit(self):
+		return self._limit
+
+_glb_weight_budget = RequestWeightBudget()
+metrics_util.set_gauge('request_weight_used', _glb_weight_budget.used)
+
+def get_weight_budget():
+	return _glb_weight_budget
+
+# {user_id: ((api_key, api_secret), BinanceClient)}, one per tenant.
+_glb_clients = {}
+_glb_client_lock = threading.Lock()
+
+def get_client(api_key, api_secret, user_id=None):
+	""" The client of a tenant's keys, shared by the worker and the handlers.
+
+	user_id: the dal.Tenant.user_id, None for the owner. New keys of a tenant replace the client of its old ones.
+	"""
+	with _glb_client_lock:
+		if user_id not in _glb_clients or _glb_clients[user_id][0] != (api_key, api_secret):
+			_glb_clients[user_id] = ((api_key, api_secret), BinanceClient(api_key, api_secret))
+		return _glb_clients[user_id][1]
+
+class SymbolInfoCache(object):
+	""" Symbol metadata (filters etc.) of the whole exchange, loaded with a single exchangeInfo request.
+
+	Reloaded after ttl seconds or after invalidate(), e.g. when an order was rejected by a filter.
+	The request is sent without holding the lock, readers are served the loaded symbols meanwhile.
 	"""
-	m = median(prices)
-	num_keep = int(math.ceil(threshold * len(prices)))
-	return sorted(prices, key=lambda price: abs(price - m))[:num_keep]
+	def __init__(self, ttl=kExchangeInfoTTL):
+		self._ttl = ttl
+		self._symbols = {}
+		self._loaded_at = None
+		# Reloads in flight.
+		self._refreshing = 0
+		self._lock = threading.Lock()
+
+	def invalidate(self):
+		self._loaded_at = None
+
+	def refresh(self, client):
+		with self._lock:
+			self._refreshing += 1
+		try:
+			symbols = {}
+			for info in _Client.get_exchange_info(client)['symbols']:
+				symbols[info['symbol']] = dict(info, filters={x['filterType']: x for x in info['filters']})
+		finally:
+			with self._lock:
+				self._refreshing -= 1
+		with self._lock:
+			self._symbols = symbols
+			self._loaded_at = time.time()
+
+	def get(self, client, symbol):
+		symbols = self.get_all(client)
+		if symbol not in symbols:
+			raise Exception('Unknown symbol: %s' % symbol)
+		return symbols[symbol]
+
+	def get_state(self):
+		""" The loaded symbols, for set_state() after a restart.
+		"""
+		with self._lock:
+			return self._symbols
+
+	def set_state(self, symbols):
+		""" Serve symbols, e.g. saved before a restart, until the next refresh. Ignored once loaded.
+		"""
+		with self._lock:
+			if self._loaded_at is None and symbols:
+				self._symbols = symbols
+				self._loaded_at = time.time()
+
+	def get_all(self, client):
+		with self._lock:
+			fresh = self._loaded_at is not None and time.time() - self._loaded_at <= self._ttl
+			# Stale symbols are good enough while another thread reloads them.
+			if fresh or (self._symbols and self._refreshing):
+				return self._symbols
+		self.refresh(client)
+		with self._lock:
+			return self._symbols
+
+_glb_symbol_info = SymbolInfoCache()
 
+def get_symbol_info_cache():
+	return _glb_symbol_info
@@ -0,0 +1,149 @@
+import collections
+import cStringIO
+import datetime
+import hashlib
+import multiprocessing
+import threading
+
+import numpy as np
+
+from constants import TRADE_TYPE, kChartProcesses, kChartCacheSize, kChartTimeout
+import metrics_util
+
+# Threshold line color per trade type.
+_COLORS = {
+	TRADE_TYPE.BUY_BELOW_AT_MARKET: 'green',
+	TRADE_TYPE.SELL_ABOVE_AT_MARKET: 'blue',
+	TRADE_TYPE.SELL_BELOW_AT_MARKET: 'red',
+	TRADE_TYPE.TRAILING_STOP_LOSS: 'orange',
+	TRADE_TYPE.ALERT_ABOVE: 'gray',
+	TRADE_TYPE.ALERT_BELOW: 'gray',
+}
+
+def render_chart(title, times, prices, thresholds):
+	""" PNG of prices over times (ms) with a dashed line per (trade type, threshold).
+
+	Runs in the chart processes, the only place matplotlib is ever imported.
+	"""
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+
+	figure, axes = plt.subplots(figsize=(8, 4.5), dpi=100)
+	try:
+		axes.plot([datetime.datetime.utcfromtimestamp(x / 1000.0) for x in times], prices, color='black', linewidth=1)
+		labeled = set()
+		for trade_type, threshold in sorted(thresholds):
+			axes.axhline(threshold, color=_COLORS.get(trade_type, 'purple'), linestyle='--', linewidth=1,
+					label=trade_type if trade_type not in labeled else None)
+			labeled.add(trade_type)
+		if labeled:
+			axes.legend(loc='best', fontsize='small')
+		axes.set_title(title)
+		axes.grid(alpha=0.3)
+		figure.autofmt_xdate()
+		f = cStringIO.StringIO()
+		figure.savefig(f, format='png')
+		return f.getvalue()
+	finally:
+		plt.close(figure)
+
+def _render_chart(args):
+	""" render_chart in a chart process, returning (png, None) or (None, error) so the callback is always called.
+	"""
+	try:
+		return render_chart(*args), None
+	except Exception as e:
+		return None, '%s: %s' % (type(e).__name__, e)
+
+class _Render(object):
+	""" A chart being rendered, every request for the same inputs waits for it.
+
+	Not an AsyncResult, as in Python 2 its get() only wakes one of the threads waiting for it.
+	"""
+	def __init__(self):
+		self.done = threading.Event()
+		self.png = None
+		self.error = None
+
+	def set(self, result):
+		self.png, self.error = result
+		self.done.set()
+
+def get_digest(title, times, prices, thresholds):
+	""" Key of the chart of these inputs, equal inputs always render the same PNG.
+	"""
+	digest = hashlib.sha1(repr((title, sorted(thresholds))))
+	digest.update(np.ascontiguousarray(times, dtype=np.int64).tobytes())
+	digest.update(np.ascontiguousarray(prices, dtype=np.float64).tobytes())
+	return digest.hexdigest()
+
+class ChartRenderer(object):
+	""" Renders charts in a pool of processes, so neither the GIL nor a lock of the bot is held meanwhile.
+
+	PNGs are cached by the digest of their inputs, the cache_size last ones are served from memory.
+	A chart being rendered is shared by every request for the same inputs.
+	"""
+	def __init__(self, processes=kChartProcesses, cache_size=kChartCacheSize):
+		self._processes = processes
+		self._cache_size = cache_size
+		self._pool = None
+		self._cache = collections.OrderedDict()
+		# {digest: _Render} of the charts being rendered.
+		self._pending = {}
+		self._lock = threading.Lock()
+
+	def start(self):
+		""" Fork the pool. Best called before the bot starts its threads, else the first chart does it.
+		"""
+		with self._lock:
+			if self._pool is None:
+				self._pool = multiprocessing.Pool(self._processes)
+
+	def render(self, title, times, prices, thresholds, timeout=kChartTimeout):
+		""" PNG of render_chart(...), only the calling thread waits for it.
+		"""
+		digest = get_digest(title, times, prices, thresholds)
+		self.start()
+		with self._lock:
+			if digest in self._cache:
+				# Most recently used last.
+				png = self._cache[digest] = self._cache.pop(digest)
+				metrics_util.inc('chart_requests_total', cached='yes')
+				return png
+			metrics_util.inc('chart_requests_total', cached='no')
+			render = self._pending.get(digest)
+			if render is None:
+				render = self._pending[digest] = _Render()
+				self._pool.apply_async(_render_chart, ((title, times, prices, thresholds),),
+						callback=lambda result: self._on_rendered(digest, render, result))
+		# A chart that times out stays pending, asking again picks it up once it's done.
+		with metrics_util.timer('chart_render_seconds'):
+			if not render.done.wait(timeout):
+				raise Exception('Chart of %s not rendered after %s seconds' % (title, timeout))
+		if render.error is not None:
+			raise Exception('Failed to render the chart of %s: %s' % (title, render.error))
+		return render.png
+
+	def _on_rendered(self, digest, render, result):
+		""" Called on the result thread of the pool.
+		"""
+		with self._lock:
+			if result[0] is not None:
+				self._cache[digest] = result[0]
+				while len(self._cache) > self._cache_size:
+					self._cache.popitem(last=False)
+			if self._pending.get(digest) is render:
+				del self._pending[digest]
+		render.set(result)
+
+	def stop(self):
+		with self._lock:
+			if self._pool is not None:
+				self._pool.terminate()
+				self._pool = None
+
+_glb_renderer = ChartRenderer()
+
+def get_renderer():
+	return _glb_renderer
@@ -12,3 +12,98 @@ kRunInterval = 10
 
 kMaxRunInterval = 60
 
+# Seconds between full reloads of the exchange symbol filters.
+kExchangeInfoTTL = 60 * 60
+
+# Evaluate triggers on websocket events instead of only every kRunInterval seconds.
+kUseStreams = False
+
+kStreamUrl = 'wss://stream.binance.com:9443/'
+
+# Track balances from the user data stream instead of polling get_account every kRunInterval.
+kUseUserStream = True
+
+# Seconds between the get_account polls that correct the streamed balances.
+kBalanceReconcileInterval = 5 * 60
+
+# Seconds between two renewals of the user data stream listenKey, Binance expires it after an hour.
+kListenKeyKeepalive = 30 * 60
+
+# 'sqlite' or 'shelve', existing shelve files are imported into sqlite on first start.
+kStorageBackend = 'sqlite'
+
+# Keep-alive connections kept open to the exchange, shared by the worker and the handlers.
+kHttpPoolSize = 10
+
+# (connect, read) timeout in seconds of every exchange request.
+kRequestTimeout = (3.05, 10)
+
+# Oldest worker snapshot (in seconds) the handlers answer from before fetching live data.
+kSnapshotMaxAge = 2 * kRunInterval
+
+# Request weight we allow ourselves per minute, Binance bans the IP above 1200.
+kRequestWeightLimit = 1000
+
+# Failed orders in a row after which a trade is removed instead of retried by the next loop.
+kMaxOrderAttempts = 3
+
+# Concurrent exchange requests of the worker's fetch stage.
+kFetchThreads = 8
+
+# Bounds of the per pair polling interval in seconds, pairs close to a threshold are polled more often.
+kMinPairInterval = 1
+kMaxPairInterval = 60
+
+# Fraction of the expected time to reach the nearest threshold to wait before the next check.
+kSchedulerSafety = 0.5
+
+# Share of kRequestWeightLimit above which the pair checks slow down further, they never exceed one per pair every kRunInterval.
+kSchedulerBudgetShare = 0.8
+
+# Floor of the relative price change per second, keeps quiet pairs from being polled too rarely.
+kMinVolatility = 1e-5
+
+kTelegramMaxMessageLength = 4096
+
+# Characters of trades on a /status page, the rest of a message is left for the prices and balances.
+kStatusPageLength = 3000
+
+# Seconds between two messages to the same chat, notifications in between are merged.
+kNotifyInterval = 1.0
+
+# Identical error reports within this many seconds are sent only once.
+kNotifyDedupInterval = 10 * 60
+
+# Recent aggregate trades kept in memory per pair.
+kTradeBufferSize = 4096
+
+# Most aggTrades requests a single pair may use to catch up in one loop.
+kMaxAggTradePages = 5
+
+# Base URL of the cryptocompare API, used for the fiat prices Binance doesn't have.
+kCryptoCompareUrl = 'https://min-api.cryptocompare.com/data/'
+
+# Seconds a cryptocompare quote is served from the cache.
+kQuoteTTL = 60
+
+# Processes rendering /chart, charts with the same inputs are served from the last kChartCacheSize ones.
+kChartProcesses = 1
+kChartCacheSize = 32
+
+# Seconds /chart waits for a chart to render.
+kChartTimeout = 30
+
+# Assets /convert bridges through when two assets have no pair of their own.
+kConvertQuotes = ('BTC', 'USDT', 'BNB', 'ETH')
+
+# Local port of the Prometheus metrics endpoint, None to disable it.
+kMetricsPort = 9108
+
+# State the worker saves to restart warm, see restart_util.
+kRestartStatePath = 'data/restart.state'
+
+# Seconds between two saves of the restart state, it is also saved on stop.
+kRestartStateInterval = 60
+
+# Trade windows and schedules of a restart state older than this are not restored, the symbol filters always are.
+kRestartStateMaxAge = 10 * 60
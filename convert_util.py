@@ -0,0 +1,106 @@
+import collections
+import threading
+
+from constants import kConvertQuotes
+import snapshot_util
+
+class ConversionGraph(object):
+	""" Assets as nodes and exchange pairs as edges, weighted by the last price of the pair.
+
+	Keeps the shortest path (fewest pairs) from every asset to each of the quote assets, so a
+	conversion only multiplies the rates along that path. The paths are recomputed only when the
+	set of pairs changes, new prices just replace the edge weights.
+	"""
+	def __init__(self, quotes=kConvertQuotes):
+		self._quotes = quotes
+		self._pairs = {}
+		self._rates = {}
+		# {quote: {asset: ((symbol, inverse), ...)}} with the pairs in the order they are traded.
+		self._paths = {}
+		self._lock = threading.Lock()
+
+	def update(self, prices, pairs):
+		"""
+		prices: {symbol: price} as returned by BinanceClient.get_prices.
+		pairs: {symbol: (base, quote)} as returned by BinanceClient.get_symbol_pairs.
+		"""
+		# Delisted symbols keep a ticker with a price of 0.
+		pairs = {x: tuple(y) for x, y in pairs.iteritems() if prices.get(x)}
+		with self._lock:
+			self._rates = prices
+			if pairs != self._pairs:
+				self._pairs = pairs
+				self._paths = self._build_paths(pairs)
+
+	def rate(self, from_asset, to_asset):
+		""" Price of one from_asset in to_asset, None if the assets aren't connected.
+		"""
+		if from_asset == to_asset:
+			return 1.0
+		with self._lock:
+			rates = self._rates
+			paths = self._paths
+		direct = rates.get(from_asset + to_asset)
+		if direct:
+			return direct
+		inverse = rates.get(to_asset + from_asset)
+		if inverse:
+			return 1 / inverse
+		# Through the quote asset with the shortest combined path.
+		best = None
+		for quote in self._quotes:
+			to_quote = paths.get(quote, {})
+			if from_asset not in to_quote or to_asset not in to_quote:
+				continue
+			hops = len(to_quote[from_asset]) + len(to_quote[to_asset])
+			if best is None or hops < best[0]:
+				best = (hops, to_quote[from_asset], to_quote[to_asset])
+		if best is None:
+			return None
+		return self._path_rate(rates, best[1]) / self._path_rate(rates, best[2])
+
+	def convert(self, quantity, from_asset, to_asset):
+		rate = self.rate(from_asset, to_asset)
+		return None if rate is None else quantity * rate
+
+	@staticmethod
+	def _path_rate(rates, path):
+		rate = 1.0
+		for symbol, inverse in path:
+			rate = rate / rates[symbol] if inverse else rate * rates[symbol]
+		return rate
+
+	def _build_paths(self, pairs):
+		edges = collections.defaultdict(list)
+		for symbol, (base, quote) in pairs.iteritems():
+			edges[base].append((quote, symbol, False))
+			edges[quote].append((base, symbol, True))
+		paths = {}
+		for quote in self._quotes:
+			# Breadth first from the quote, every edge is walked backwards so the path starts at the asset.
+			to_quote = {quote: ()}
+			queue = collections.deque([quote])
+			while queue:
+				asset = queue.popleft()
+				for neighbour, symbol, inverse in edges[asset]:
+					if neighbour not in to_quote:
+						# Selling neighbour for asset is the opposite direction of the edge.
+						to_quote[neighbour] = ((symbol, not inverse),) + to_quote[asset]
+						queue.append(neighbour)
+			paths[quote] = to_quote
+		return paths
+
+_glb_graph = ConversionGraph()
+_glb_graph_prices = None
+_glb_graph_lock = threading.Lock()
+
+def get_graph(client):
+	""" The conversion graph of the current price snapshot, refreshed when a newer snapshot is published.
+	"""
+	global _glb_graph_prices
+	prices = snapshot_util.get_prices(client)
+	with _glb_graph_lock:
+		if prices is not _glb_graph_prices:
+			_glb_graph.update(prices, client.get_symbol_pairs())
+			_glb_graph_prices = prices
+	return _glb_graph
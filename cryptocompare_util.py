@@ -1,15 +1,146 @@
+import logging
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from constants import kCryptoCompareUrl, kQuoteTTL, kHttpPoolSize, kRequestTimeout
+
+# Longest fsyms and tsyms lists pricemulti accepts, in characters.
+_MAX_FSYMS_LENGTH = 300
+_MAX_TSYMS_LENGTH = 100
+
+class _Fetch(object):
+	""" A pricemulti request in flight, the callers wanting the same quotes wait for it.
+	"""
+	def __init__(self):
+		self.done = threading.Event()
+		self.error = None
+
+def _chunks(symbols, max_length):
+	""" symbols split into comma separated lists of at most max_length characters.
+	"""
+	chunk = []
+	length = 0
+	for symbol in symbols:
+		if chunk and length + len(symbol) + 1 > max_length:
+			yield chunk
+			chunk, length = [], 0
+		chunk.append(symbol)
+		length += len(symbol) + 1
+	if chunk:
+		yield chunk
+
+class QuoteService(object):
+	""" Prices of cryptocompare, batched through pricemulti over a keep-alive session.
+
+	Quotes are cached for ttl seconds. A quote already being fetched by another thread is waited
+	for instead of requested again, so concurrent callers share a single request.
+	"""
+	def __init__(self, base_url=kCryptoCompareUrl, ttl=kQuoteTTL, timeout=kRequestTimeout):
+		"""
+		base_url: e.g. http://127.0.0.1:8000/ to run against a local stand-in.
+		"""
+		self._base_url = base_url.rstrip('/') + '/'
+		self._ttl = ttl
+		self._timeout = timeout
+		self._session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=kHttpPoolSize)
+		self._session.mount('https://', adapter)
+		self._session.mount('http://', adapter)
+		# {(fsym, tsym, exchange): (price, fetched at)}
+		self._quotes = {}
+		# {(fsym, tsym, exchange): _Fetch}
+		self._fetches = {}
+		self._lock = threading.Lock()
+
+	def get_price(self, fsym, tsym, exchange=None):
+		prices = self.get_prices((fsym,), (tsym,), exchange)
+		if tsym not in prices.get(fsym, {}):
+			raise Exception('No price for %s/%s' % (fsym, tsym))
+		return prices[fsym][tsym]
+
+	def get_prices(self, fsyms, tsyms, exchange=None):
+		""" {fsym: {tsym: price}} of every pair cryptocompare knows, with a single request for all the stale ones.
+
+		exchange: e.g. 'Coinbase', the aggregate of all exchanges by default.
+		"""
+		keys = set((fsym, tsym, exchange) for fsym in fsyms for tsym in tsyms)
+		while True:
+			now = time.time()
+			with self._lock:
+				missing = set(x for x in keys if x not in self._quotes or now - self._quotes[x][1] > self._ttl)
+				waits = set(self._fetches[x] for x in missing if x in self._fetches)
+				fetch = None
+				missing = [x for x in missing if x not in self._fetches]
+				if missing:
+					fetch = _Fetch()
+					for key in missing:
+						self._fetches[key] = fetch
+			if fetch is not None:
+				self._fetch(fetch, missing, exchange)
+			for other in waits:
+				other.done.wait()
+			if fetch is not None and fetch.error is not None:
+				raise fetch.error
+			# Quotes of failed fetches of other callers are fetched again.
+			if not waits or all(x.error is None for x in waits):
+				break
+		prices = {}
+		with self._lock:
+			for key in keys:
+				if self._quotes.get(key, (None,))[0] is not None:
+					prices.setdefault(key[0], {})[key[1]] = self._quotes[key][0]
+		return prices
+
+	def _fetch(self, fetch, keys, exchange):
+		try:
+			fsyms = sorted(set(x[0] for x in keys))
+			tsyms = sorted(set(x[1] for x in keys))
+			for tsym_chunk in _chunks(tsyms, _MAX_TSYMS_LENGTH):
+				for fsym_chunk in _chunks(fsyms, _MAX_FSYMS_LENGTH):
+					self._request(fsym_chunk, tsym_chunk, exchange)
+		except Exception as e:
+			logging.error('Failed to get cryptocompare prices: %s', e)
+			fetch.error = e
+		finally:
+			with self._lock:
+				for key in keys:
+					if self._fetches.get(key) is fetch:
+						del self._fetches[key]
+			fetch.done.set()
+
+	def _request(self, fsyms, tsyms, exchange):
+		params = {
+			'fsyms': ','.join(fsyms),
+			'tsyms': ','.join(tsyms),
+		}
+		if exchange is not None:
+			params['e'] = exchange
+		r = self._session.get(self._base_url + 'pricemulti', params=params, timeout=self._timeout)
+		if r.status_code != 200:
+			raise Exception('Invalid status code: %s' % r.status_code)
+		j = r.json()
+		if 'Response' in j and j['Response'] == 'Error':
+			raise Exception('Error: %s' % j['Message'])
+		now = time.time()
+		with self._lock:
+			# Pairs cryptocompare doesn't know are cached as None, so they aren't asked for again every time.
+			for fsym in fsyms:
+				for tsym in tsyms:
+					price = j.get(fsym, {}).get(tsym)
+					self._quotes[(fsym, tsym, exchange)] = (float(price) if price is not None else None, now)
+
+_glb_service = None
+_glb_service_lock = threading.Lock()
 
-def get_price(fsym, tsym, e):
-	r = requests.get('https://min-api.cryptocompare.com/data/price', params={
-		'fsym': fsym,
-		'tsyms': tsym,
-		'e': e,
-	})
-	if r.status_code != 200:
-		raise Exception('Invalid status code: %s' % r.status_code)
-	j = r.json()
-	if 'Response' in j and j['Response'] == 'Error':
-		raise Exception('Error: %s' % j['Message'])
-	return r.json()[tsym]
+def get_service():
+	global _glb_service
+	with _glb_service_lock:
+		if _glb_service is None:
+			_glb_service = QuoteService()
+		return _glb_service
 
+def get_price(fsym, tsym, e=None):
+	return get_service().get_price(fsym, tsym, e)
@@ -1,13 +1,178 @@
 
-import shelve as _shelve
+import contextlib
+
 from binance_util import BinanceClient
-from constants import TRADE_TYPE
+from constants import TRADE_TYPE, kStorageBackend
+from storage import ShelveTable, SqliteStore
+from threading_util import requires_lock, requires_read_lock
+from trigger_index import TriggerIndex
+from trade_book import TradeBook
 #from binance.exceptions import BinanceAPIException
 
-
-config = _shelve.open('data/config.shelve')
-
-trades_db = _shelve.open('data/open_trades.shelve')
+# Indexed trade columns, used by find_trades_by_pair.
+_TRADE_COLUMNS = {
+	'pair': lambda trade: trade['pair'][0] + trade['pair'][1],
+	'type': lambda trade: trade['type'],
+}
+
+if kStorageBackend == 'sqlite':
+	_store = SqliteStore('data/kzbot.sqlite')
+
+def _open_tables(suffix=''):
+	""" (config, trades_db) of a tenant, suffix is '' for the default one.
+	"""
+	if kStorageBackend == 'sqlite':
+		return (_store.open_table('config' + suffix, shelve_path='data/config%s.shelve' % suffix),
+				_store.open_table('open_trades' + suffix, columns=_TRADE_COLUMNS, shelve_path='data/open_trades%s.shelve' % suffix))
+	return ShelveTable('data/config%s.shelve' % suffix), ShelveTable('data/open_trades%s.shelve' % suffix, columns=_TRADE_COLUMNS)
+
+class Tenant(object):
+	""" A user of the bot: its config (keys, chat), open trades and the indexes over them.
+
+	Every tenant trades on its own account, the market data is shared, see MyWorker.
+	"""
+	def __init__(self, user_id, config, trades_db):
+		self.user_id = user_id
+		self.config = config
+		self.trades_db = trades_db
+		# Kept in sync with trades_db, always go through save_trades / update_trade / delete_trade.
+		self.trigger_index = TriggerIndex(trades_db.iteritems())
+		self.trade_book = TradeBook(trades_db.iteritems())
+		# Bumped on every change of trades_db, lets readers tell whether their copy is still current.
+		self.version = 0
+
+	def get_trades_version(self):
+		return self.version
+
+	@requires_read_lock
+	def get_trades(self):
+		""" A private copy of the open trades and the version it was read at.
+		"""
+		return self.version, dict(self.trades_db.items())
+
+	@requires_lock
+	def save_trades(self, trades):
+		for trade in trades:
+			next_id = self.config['next_id'] if 'next_id' in self.config else 0
+			trade['id'] = next_id
+
+			self.trades_db[str(next_id)] = trade
+			self.trigger_index.add(str(next_id), trade)
+			self.trade_book.add(str(next_id), trade)
+			self.config['next_id'] = next_id + 1
+
+		self.version += 1
+		self.trades_db.sync()
+		self.config.sync()
+
+	def save_alert(self, alert):
+		return self.save_trades([alert])
+
+	@requires_lock
+	def update_trade(self, key, trade):
+		self.trades_db[key] = trade
+		self.trigger_index.update(key, trade)
+		self.trade_book.update(key, trade)
+		self.version += 1
+
+	@requires_lock
+	def delete_trade(self, key):
+		del self.trades_db[key]
+		self.trigger_index.remove(key)
+		self.trade_book.remove(key)
+		self.version += 1
+
+	@requires_lock
+	def compare_and_update(self, key, expected, trade):
+		""" Replace the trade only if it still equals expected, i.e. nobody changed it since it was read.
+		"""
+		if key not in self.trades_db or self.trades_db[key] != expected:
+			return False
+		self.update_trade(key, trade)
+		return True
+
+	@requires_lock
+	def compare_and_delete(self, key, expected):
+		""" Delete the trade only if it still equals expected, i.e. nobody changed it since it was read.
+		"""
+		if key not in self.trades_db or self.trades_db[key] != expected:
+			return False
+		self.delete_trade(key)
+		return True
+
+	@contextlib.contextmanager
+	def batch(self):
+		""" Commit the trade changes of the block as one transaction, hold the write side of state_lock around it.
+
+		On an error none of them is kept, the indexes are rebuilt from the rolled back trades_db.
+		"""
+		try:
+			with self.trades_db.batch():
+				yield self
+		except:
+			self.trigger_index = TriggerIndex(self.trades_db.iteritems())
+			self.trade_book = TradeBook(self.trades_db.iteritems())
+			self.version += 1
+			raise
+
+	def find_trades_by_pair(self, pair_str):
+		return self.trades_db.find(pair=pair_str)
+
+# The owner of the bot. Its tables are the ones of the single user bot, the functions below act on it.
+_glb_default = Tenant(None, *_open_tables())
+# {user_id: Tenant} of the other users, listed in the 'tenant_ids' of the owner's config.
+_glb_tenants = {}
+
+config = _glb_default.config
+trades_db = _glb_default.trades_db
+trigger_index = _glb_default.trigger_index
+trade_book = _glb_default.trade_book
+
+get_trades_version = _glb_default.get_trades_version
+get_trades = _glb_default.get_trades
+save_trades = _glb_default.save_trades
+save_alert = _glb_default.save_alert
+update_trade = _glb_default.update_trade
+delete_trade = _glb_default.delete_trade
+compare_and_update = _glb_default.compare_and_update
+compare_and_delete = _glb_default.compare_and_delete
+find_trades_by_pair = _glb_default.find_trades_by_pair
+
+def get_owner():
+	return _glb_default
+
+def _get_tenant(user_id):
+	if user_id not in _glb_tenants:
+		_glb_tenants[user_id] = Tenant(user_id, *_open_tables('_%d' % user_id))
+	return _glb_tenants[user_id]
+
+@requires_lock
+def get_tenant(user_id):
+	""" The tenant of a telegram user, None if the owner didn't add the user.
+
+	Until somebody sent /start the first user is taken as the owner.
+	"""
+	if user_id == config.get('owner_id', user_id):
+		return _glb_default
+	if user_id in config.get('tenant_ids', ()):
+		return _get_tenant(user_id)
+	return None
+
+@requires_lock
+def get_tenants():
+	""" The owner followed by the other tenants, in the order they were added.
+	"""
+	return [_glb_default] + [_get_tenant(x) for x in config.get('tenant_ids', ())]
+
+@requires_lock
+def add_tenant(user_id):
+	if user_id == config.get('owner_id'):
+		return _glb_default
+	tenant_ids = config.get('tenant_ids', [])
+	if user_id not in tenant_ids:
+		config['tenant_ids'] = tenant_ids + [user_id]
+		config.sync()
+	return _get_tenant(user_id)
 
 def get_flat_symbols(trades_db):
 	pairs = [x['pair'] for x in trades_db.itervalues()]
@@ -37,17 +202,6 @@ def create_trade(client, pair, quantity, type, threshold):
 
 	return trade
 
-def save_trades(trades):
-	for trade in trades:
-		next_id = config['next_id'] if 'next_id' in config else 0
-		trade['id'] = next_id
-
-		trades_db[str(next_id)] = trade
-		config['next_id'] = next_id + 1
-
-	trades_db.sync()
-	config.sync()
-
 def create_alert(client, pair, threshold):
 	prices = client.get_prices((pair,))
 	current_price = prices[pair[0] + pair[1]]
@@ -64,14 +218,3 @@ def create_alert(client, pair, threshold):
 
 	return alert
 
-
-def save_alert(alert):
-	return save_trades([alert])
-
-def find_trades_by_pair(pair_str):
-	trade_ids = set()
-	for key, trade in trades_db.iteritems():
-		if ("%s%s" % trade['pair']) == pair_str:
-			trade_ids.add(key)
-	return trade_ids
-
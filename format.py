@@ -27,11 +27,26 @@ def format_scientific(value, exp=None):
 		return "%.2f" % value
 	return "%.2fe%d" % (value / 10**exp, exp)
 
-def format_prices(prices):
-	return '\n'.join(['%s: %s' % (x[0], format_scientific(x[1])) for x in prices.iteritems()])
+def format_balances(balances, usd_prices=None):
+	"""
+	usd_prices: {asset: USD price}, adds the USD value of the assets that have one.
+	"""
+	usd_prices = usd_prices or {}
+	lines = []
+	for asset, balance in balances.iteritems():
+		total = balance['free'] + balance['locked']
+		if asset in usd_prices:
+			lines.append('%s: %s ($%.2f)' % (asset, format_scientific(total), total * usd_prices[asset]))
+		else:
+			lines.append('%s: %s' % (asset, format_scientific(total)))
+	return '\n'.join(lines)
 
-def format_balances(balances):
-	return '\n'.join(['%s: %s' % (x, format_scientific(y['free'] + y['locked'])) for x, y in balances.iteritems()])
+def format_trade(trade, exp, use_repr=False):
+	if use_repr:
+		return repr(trade)
+	if trade['type'] == _TRADE_TYPE.ALERT_BELOW or trade['type'] == _TRADE_TYPE.ALERT_ABOVE:
+		return "%s %s (id=%d)" % (format_scientific(trade['threshold'], exp), trade['type'], trade['id'])
+	return "%s %s %s (id=%d)" % (format_scientific(trade['threshold'], exp), trade['type'], trade['quantity'], trade['id'])
 
 def format_trades(trades, use_repr, prices):
 	trades = sorted(trades, key=lambda trade: (trade['pair'][0], trade['pair'][1], trade['threshold']))
@@ -45,18 +60,27 @@ def format_trades(trades, use_repr, prices):
 		if pair != last_pair:
 			last_pair = pair
 			lines.append("%s:" % pair)
-		exp = find_exp(prices[pair])
-		if trade['type'] == _TRADE_TYPE.ALERT_BELOW or trade['type'] == _TRADE_TYPE.ALERT_ABOVE:
-			lines.append("%s %s (id=%d)" % (format_scientific(trade['threshold'], exp), trade['type'], trade['id']))
-		else:
-			lines.append("%s %s %s (id=%d)" % (format_scientific(trade['threshold'], exp), trade['type'], trade['quantity'], trade['id']))
+		lines.append(format_trade(trade, find_exp(prices[pair])))
 	return '\n'.join(lines)
 
-def build_status_msg(trades, prices, balances, use_repr=False):
-	text = ['Status:', format_trades(trades.itervalues(), use_repr, prices)]
-	if trades:
-		text.append('\nPrices:\n%s' % format_prices(prices))
-	text.append('\nBalances:\n%s' % format_balances(balances))
-
-	return '\n'.join(text)
+def format_pair_header(pair, price, schedule=None):
+	""" e.g. 'LTCBTC: 18.90e-3, every 5s, next in 2s', schedule being (seconds until the next check, interval).
+	"""
+	text = '%s%s: %s' % (pair[0], pair[1], format_scientific(price) if price is not None else '-')
+	if schedule is not None:
+		next_check, interval = schedule
+		interval = '%ds' % interval if interval is not None else '-'
+		text += ', every %s, next in %ds' % (interval, next_check)
+	return text
 
+def format_metrics(histograms, counters, gauges):
+	""" Text of metrics_util.get_metrics(), timings in milliseconds.
+	"""
+	lines = []
+	for name, labels, (count, total, max_value) in histograms:
+		labels = ','.join(str(x[1]) for x in labels)
+		lines.append('%s %s: n=%d avg=%.1fms max=%.1fms' % (name, labels, count, total / count * 1000 if count else 0, max_value * 1000))
+	for name, labels, value in counters + gauges:
+		labels = ','.join(str(x[1]) for x in labels)
+		lines.append('%s %s: %s' % (name, labels, value) if labels else '%s: %s' % (name, value))
+	return '\n'.join(lines) or 'No metrics yet.'
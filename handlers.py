@@ -1,19 +1,26 @@
 
 import datetime
 import dal
+import io
 import logging
 
-from telegram.ext import CommandHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import CommandHandler, CallbackQueryHandler
 from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError)
 
 from constants import kRunInterval
-from threading_util import requires_lock
-from telegram_util import bot_msg_exception, verify_owner
-from dal import config, trades_db, get_flat_symbols, find_trades_by_pair
-from format import build_status_msg, format_scientific, format_trades, find_exp
-from binance_util import BinanceClient
+from threading_util import state_lock, requires_lock
+from telegram_util import bot_msg_exception, verify_owner, verify_tenant
+from format import format_scientific, format_trades, find_exp, format_metrics
+from binance_util import get_client, get_weight_budget
+from window_util import parse_agg_trades
 from my_worker import get_instance as get_worker
 import cryptocompare_util as cryptocompare
+import snapshot_util
+import convert_util
+import metrics_util
+import status_util
+import chart_util
 
 _USAGE = """
 /start <API_KEY> <API_SECRET>
@@ -23,82 +30,129 @@ _USAGE = """
 1 SELL_BELOW_AT_MARKET 0.2 # Stop loss
 1 TRAILING_STOP_LOSS 0.1 # 10% trailing stop loss
 /info LTC BTC
+/chart LTC BTC - recent prices with the thresholds of your trades.
 /alert LTC BTC 0.23
-/status - get current status of open trades.
+/status [LTCBTC|LTC] [repr] - get current status of open trades, optionally of a single pair or asset.
 /remove <TRADE_ID>
+/metrics - timings of the worker loop and the exchange requests.
+/adduser <TELEGRAM_USER_ID> - let another user trade on the bot with their own keys.
 """
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def start_handler(bot, update, args):
+@verify_tenant
+def start_handler(bot, update, args, tenant):
 	logging.debug("Responding to /start: %s" % args)
 	if len(args) != 2:
 		text = 'Wrong Usage'
 		bot.send_message(chat_id=update.message.chat_id, text=text)
 		return
 
-	config['chat_id'] = update.message.chat_id
-	config['owner_id'] = update.message.from_user.id
-	config['api_key'] = str(args[0])
-	config['secret'] = str(args[1])
-	config.sync()
+	config = tenant.config
+	with state_lock.write():
+		config['chat_id'] = update.message.chat_id
+		if tenant is dal.get_owner():
+			config['owner_id'] = update.message.from_user.id
+		config['api_key'] = str(args[0])
+		config['secret'] = str(args[1])
+		config.sync()
+	# The other tenants are picked up by the next loop of the worker.
+	if tenant is dal.get_owner():
+		get_worker().set_client(get_client(config['api_key'], config['secret']))
 
 	bot.send_message(chat_id=update.message.chat_id, text="ack!")
 
-@requires_lock
 @bot_msg_exception
 @verify_owner
-def status_handler(bot, update, args):
+def adduser_handler(bot, update, args):
+	logging.debug("Responding to /adduser: %s" % args)
+	if len(args) != 1:
+		text = 'Wrong Usage'
+		bot.send_message(chat_id=update.message.chat_id, text=text)
+		return
+
+	dal.add_tenant(int(args[0]))
+	bot.send_message(chat_id=update.message.chat_id, text='ack! They can /start with their own keys now.')
+
+def get_tenant_client(tenant):
+	if 'api_key' not in tenant.config:
+		raise Exception('No keys yet, send /start <API_KEY> <API_SECRET> first')
+	return get_client(tenant.config['api_key'], tenant.config['secret'], tenant.user_id)
+
+@bot_msg_exception
+@verify_tenant
+def status_handler(bot, update, args, tenant):
 	logging.debug("Responding to /status: %s." % args)
-	client = BinanceClient(config['api_key'], config['secret'])
-	use_repr = (len(args) and args[0] == 'repr')
+	use_repr = 'repr' in args
+	pair_filter = ([str(x).upper() for x in args if x != 'repr'] or [None])[0]
+	# The filter ends up in the callback data of the page buttons, which only take a short word.
+	if pair_filter is not None and not is_known_symbol(get_tenant_client(tenant), pair_filter):
+		bot.send_message(chat_id=update.message.chat_id, text='Unknown symbol or asset: %s' % pair_filter)
+		return
+	send_status(bot, update, tenant, 0, pair_filter, use_repr)
 
-	balances = client.get_balances(get_flat_symbols(trades_db))
-	prices = client.get_prices([trade['pair'] for trade in trades_db.itervalues()])
-	text = build_status_msg(trades_db, prices, balances, use_repr=use_repr)
-	bot.send_message(chat_id=update.message.chat_id, text=text)
+def is_known_symbol(client, name):
+	""" Whether name is a symbol (LTCBTC) or an asset (LTC) of the exchange.
+	"""
+	pairs = client.get_symbol_pairs()
+	return name in pairs or any(name in x for x in pairs.itervalues())
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def ping_handler(bot, update):
+@verify_tenant
+def status_page_handler(bot, update, groups, tenant):
+	logging.debug("Responding to status page: %s." % update.callback_query.data)
+	update.callback_query.answer()
+	page, pair_filter, use_repr = groups
+	send_status(bot, update, tenant, int(page), pair_filter or None, use_repr == '1', edit=True)
+
+def send_status(bot, update, tenant, page, pair_filter, use_repr, edit=False):
+	""" Send a /status page, or show it in place of the page whose button was pressed with edit.
+	"""
+	client = get_tenant_client(tenant)
+	prices = snapshot_util.get_prices(client)
+	balances = snapshot_util.get_balances(client)
+	usd_prices = get_usd_prices([x for x, y in balances.iteritems() if y['free'] + y['locked'] > 0])
+	text, page, pages = status_util.get_view(tenant).render(page, prices, balances, get_worker().get_schedule(), pair_filter, use_repr, usd_prices)
+
+	buttons = []
+	callback_data = 'status:%%d:%s:%d' % (pair_filter or '', use_repr)
+	if page > 0:
+		buttons.append(InlineKeyboardButton('< Prev', callback_data=callback_data % (page - 1)))
+	if page + 1 < pages:
+		buttons.append(InlineKeyboardButton('Next >', callback_data=callback_data % (page + 1)))
+	reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+	if edit:
+		bot.edit_message_text(text=text, chat_id=update.effective_chat.id, message_id=update.callback_query.message.message_id, reply_markup=reply_markup)
+	else:
+		bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
+
+@bot_msg_exception
+@verify_tenant
+def ping_handler(bot, update, tenant):
 	logging.debug("Responding to /ping.")
 
-	time_since_run = (datetime.datetime.now() - get_worker().last_run).total_seconds()
+	worker = get_worker()
+	time_since_run = (datetime.datetime.now() - worker.last_run).total_seconds()
 	if time_since_run < 2 * kRunInterval:
 		text = "OK!"
 	else:
 		text = "Something is wrong ..."
+	budget = get_weight_budget()
+	text += '\nRequest weight: %s last loop, %d/%d last minute.' % (worker.last_loop_weight, budget.used(), budget.limit)
 	bot.send_message(chat_id=update.message.chat_id, text=text)
 
-@requires_lock
 @bot_msg_exception
 @verify_owner
-def remove_handler(bot, update, args):
-	logging.debug("Responding to /remove: args=%r." % args)
-	text = []
-
-	for arg in args:
-		try:
-			arg = str(int(arg))
-		except ValueError:
-			arg = str(arg).upper()
-
-		if arg in trades_db:
-			key = arg
-			text.append('Trade removed: %s' % trades_db[key])
-			del trades_db[key]
-			continue
-		keys = find_trades_by_pair(arg)
-		if len(keys):
-			for key in keys:
-				text.append('Trade removed: %s' % trades_db[key])
-				del trades_db[key]
-			continue
-		text.append('key %r not found!' % arg)
+def metrics_handler(bot, update):
+	logging.debug("Responding to /metrics.")
+	text = format_metrics(*metrics_util.get_metrics())
+	bot.send_message(chat_id=update.message.chat_id, text=text)
 
-	trades_db.sync()
+@bot_msg_exception
+@verify_tenant
+def remove_handler(bot, update, args, tenant):
+	logging.debug("Responding to /remove: args=%r." % args)
+	text = remove_trades(tenant, args)
+	get_worker().update_subscriptions()
 
 	bot.send_message(chat_id=update.message.chat_id, text='\n\n'.join(text))
 
@@ -110,15 +164,14 @@ min_price: %s
 price_step: %s
 """.strip()
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def info_handler(bot, update, args):
+@verify_tenant
+def info_handler(bot, update, args, tenant):
 	logging.debug("Responding to /info: args=%r." % args)
 	pair = (str(args[0]).upper(), str(args[1]).upper())
 
-	client = BinanceClient(config['api_key'], config['secret'])
-	prices = client.get_prices((pair,))
+	client = get_tenant_client(tenant)
+	prices = snapshot_util.get_prices(client, (pair,))
 	current_price = prices[pair[0] + pair[1]]
 
 	symbol_info = client.get_symbol_info(pair)
@@ -134,80 +187,91 @@ def info_handler(bot, update, args):
 	)
 	bot.send_message(chat_id=update.message.chat_id, text=text)
 
-def reverse_price(price):
-	if price is None:
-		return price
-	return 1 / price
+@bot_msg_exception
+@verify_tenant
+def chart_handler(bot, update, args, tenant):
+	logging.debug("Responding to /chart: args=%r." % args)
+	pair = (str(args[0]).upper(), str(args[1]).upper())
+
+	history = get_worker().get_price_history(pair)
+	if history is None:
+		# Pairs without open trades aren't polled, chart their last trades.
+		prices, _, times = parse_agg_trades(get_tenant_client(tenant).get_aggregate_trades(symbol=pair[0] + pair[1]))
+		history = (times, prices)
+	_, trades = tenant.get_trades()
+	thresholds = [(x['type'], x['threshold']) for x in trades.itervalues() if tuple(x['pair']) == pair]
+
+	# Rendered in the chart processes, nothing is locked while this thread waits.
+	png = chart_util.get_renderer().render('/'.join(pair), history[0], history[1], thresholds)
+	bot.send_photo(chat_id=update.message.chat_id, photo=io.BytesIO(png))
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def convert_handler(bot, update, args):
+@verify_tenant
+def convert_handler(bot, update, args, tenant):
 	logging.debug("Responding to /convert: args=%r." % args)
 	quantity = float(args[0])
 	pair = (str(args[1]).upper(), str(args[2]).upper())
 
-	client = BinanceClient(config['api_key'], config['secret'])
-	prices = client.get_prices()
-	current_price = prices.get(pair[0] + pair[1], None) or reverse_price(prices.get(pair[1] + pair[0], None))
-	bridge_price_1 = prices.get(pair[0] + 'BTC', None) or reverse_price(prices.get('BTC' + pair[0], None))
-	bridge_price_2 = prices.get('BTC' + pair[1], None) or reverse_price(prices.get(pair[1] + 'BTC', None))
-
+	client = get_tenant_client(tenant)
+	converted = convert_util.get_graph(client).convert(quantity, pair[0], pair[1])
+	if converted is None:
+		# Fiat currencies aren't traded on Binance.
+		prices = cryptocompare.get_service().get_prices((pair[0],), (pair[1],))
+		if pair[1] in prices.get(pair[0], {}):
+			converted = quantity * prices[pair[0]][pair[1]]
 
-	if current_price is not None:
-		#exp = find_exp(current_price)
-		text = format_scientific(quantity * current_price)
-	elif bridge_price_1 is not None and bridge_price_2 is not None:
-		text = format_scientific(quantity * bridge_price_1 * bridge_price_2)
+	if converted is not None:
+		text = format_scientific(converted)
 	else:
 		text = 'Cannot find price for %s' % (pair,)
 
 	bot.send_message(chat_id=update.message.chat_id, text=text)
 
-#def get_price(fsym, tsym, client):
-#	if tsym == 'USD':
-#		current_price = cryptocompare.get_price(fsym, tsym, 'Coinbase')
-#	else:
-#		prices = client.get_prices(((fsym, tsym),))
-#		current_price = prices[fsym + tsym]
-#	return current_price
+def get_usd_prices(assets):
+	""" {asset: USD price} of the assets cryptocompare knows, in one request cached for kQuoteTTL.
+
+	Empty when cryptocompare is unavailable, the status is still worth sending without it.
+	"""
+	try:
+		prices = cryptocompare.get_service().get_prices(assets, ('USD',))
+	except Exception as e:
+		logging.error('No USD prices: %s', e)
+		return {}
+	return {x: y['USD'] for x, y in prices.iteritems()}
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def trade_handler(bot, update, args):
-	global open_trades, config
+@verify_tenant
+def trade_handler(bot, update, args, tenant):
 	logging.debug("Responding to /trade: args=%r." % args)
-	client = BinanceClient(config['api_key'], config['secret'])
+	client = get_tenant_client(tenant)
 
 	trades = create_trades(client, args)
-	dal.save_trades(trades)
-	prices = client.get_prices((trades[0]['pair'],))
+	tenant.save_trades(trades)
+	get_worker().update_subscriptions()
+	prices = snapshot_util.get_prices(client, (trades[0]['pair'],))
 
 	text = [format_trades(trades, True, prices), '\nack!']
 
 	bot.send_message(chat_id=update.message.chat_id, text='\n'.join(text))
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def alert_handler(bot, update, args):
-	global open_trades, config
+@verify_tenant
+def alert_handler(bot, update, args, tenant):
 	logging.debug("Responding to /alert: args=%r." % args)
 
-	client = BinanceClient(config['api_key'], config['secret'])
+	client = get_tenant_client(tenant)
 	alert = create_alert(client, args)
 
-	dal.save_alert(alert)
+	tenant.save_alert(alert)
+	get_worker().update_subscriptions()
 
-	text = [str(trade), '\nack!']
+	text = [str(alert), '\nack!']
 
 	bot.send_message(chat_id=update.message.chat_id, text='\n'.join(text))
 
-@requires_lock
 @bot_msg_exception
-@verify_owner
-def help_handler(bot, update):
+@verify_tenant
+def help_handler(bot, update, tenant):
 	logging.debug("Responding to /help.")
 	bot.send_message(chat_id=update.message.chat_id, text=_USAGE.strip())
 
@@ -240,9 +304,13 @@ def register_handlers(dispatcher):
 	dispatcher.add_handler(CommandHandler('alert', alert_handler, pass_args=True))
 	dispatcher.add_handler(CommandHandler('info', info_handler, pass_args=True))
 	dispatcher.add_handler(CommandHandler('convert', convert_handler, pass_args=True))
+	dispatcher.add_handler(CommandHandler('chart', chart_handler, pass_args=True))
 	dispatcher.add_handler(CommandHandler('remove', remove_handler, pass_args=True))
 	dispatcher.add_handler(CommandHandler('status', status_handler, pass_args=True))
+	dispatcher.add_handler(CallbackQueryHandler(status_page_handler, pattern=r'^status:(\d+):(\w*):([01])$', pass_groups=True))
 	dispatcher.add_handler(CommandHandler('ping', ping_handler))
+	dispatcher.add_handler(CommandHandler('metrics', metrics_handler))
+	dispatcher.add_handler(CommandHandler('adduser', adduser_handler, pass_args=True))
 	dispatcher.add_handler(CommandHandler('help', help_handler))
 	dispatcher.add_error_handler(error_callback)
 
@@ -256,6 +324,33 @@ def create_trades(client, args):
 
 	return trades
 
+@requires_lock
+def remove_trades(tenant, args):
+	trades_db = tenant.trades_db
+	text = []
+
+	for arg in args:
+		try:
+			arg = str(int(arg))
+		except ValueError:
+			arg = str(arg).upper()
+
+		if arg in trades_db:
+			key = arg
+			text.append('Trade removed: %s' % trades_db[key])
+			tenant.delete_trade(key)
+			continue
+		keys = tenant.find_trades_by_pair(arg)
+		if len(keys):
+			for key in keys:
+				text.append('Trade removed: %s' % trades_db[key])
+				tenant.delete_trade(key)
+			continue
+		text.append('key %r not found!' % arg)
+
+	trades_db.sync()
+	return text
+
 def create_alert(client, args):
 	pair = (str(args[0]).upper(), str(args[1]).upper())
 	return dal.create_alert(client, pair, float(args[2]))
@@ -0,0 +1,135 @@
+import BaseHTTPServer
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Histogram(object):
+	__slots__ = ('counts', 'sum', 'count', 'max')
+
+	def __init__(self):
+		self.counts = [0] * (len(_BUCKETS) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.max = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(_BUCKETS, value)] += 1
+		self.sum += value
+		self.count += 1
+		if value > self.max:
+			self.max = value
+
+# {(name, labels): _Histogram or count}, labels being a sorted tuple of (label, value).
+_glb_histograms = {}
+_glb_counters = {}
+# {name: function returning the current value}
+_glb_gauges = {}
+_glb_lock = threading.Lock()
+
+def _key(name, labels):
+	return name, tuple(sorted(labels.iteritems()))
+
+def observe(name, value, **labels):
+	""" Add value to the histogram name, e.g. observe('request_seconds', 0.2, endpoint='account').
+	"""
+	key = _key(name, labels)
+	with _glb_lock:
+		histogram = _glb_histograms.get(key)
+		if histogram is None:
+			histogram = _glb_histograms[key] = _Histogram()
+		histogram.observe(value)
+
+def inc(name, value=1, **labels):
+	key = _key(name, labels)
+	with _glb_lock:
+		_glb_counters[key] = _glb_counters.get(key, 0) + value
+
+def set_gauge(name, func):
+	""" Report func() as the value of name whenever the metrics are read.
+	"""
+	with _glb_lock:
+		_glb_gauges[name] = func
+
+@contextlib.contextmanager
+def timer(name, **labels):
+	""" Observe the wall time of the block in the histogram name, also when it raises.
+	"""
+	started = time.time()
+	try:
+		yield
+	finally:
+		observe(name, time.time() - started, **labels)
+
+def get_metrics():
+	""" (histograms, counters, gauges) as lists of (name, labels, value), histograms as (count, sum, max).
+	"""
+	with _glb_lock:
+		histograms = sorted((name, labels, (x.count, x.sum, x.max)) for (name, labels), x in _glb_histograms.iteritems())
+		counters = sorted((name, labels, x) for (name, labels), x in _glb_counters.iteritems())
+		gauges = sorted(_glb_gauges.iteritems())
+	return histograms, counters, [(name, (), _gauge_value(func)) for name, func in gauges]
+
+def _gauge_value(func):
+	try:
+		return func()
+	except Exception:
+		return float('nan')
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (x, str(y).replace('\\', '\\\\').replace('"', '\\"')) for x, y in labels)
+
+def render_prometheus(prefix='kzbot_'):
+	""" All metrics in the Prometheus text exposition format.
+	"""
+	with _glb_lock:
+		histograms = sorted((key, list(x.counts), x.sum, x.count) for key, x in _glb_histograms.iteritems())
+		counters = sorted(_glb_counters.iteritems())
+		gauges = sorted(_glb_gauges.iteritems())
+	lines = []
+	typed = set()
+	for (name, labels), counts, total, count in histograms:
+		if name not in typed:
+			typed.add(name)
+			lines.append('# TYPE %s%s histogram' % (prefix, name))
+		cumulative = 0
+		for bound, bucket in zip(_BUCKETS + ('+Inf',), counts):
+			cumulative += bucket
+			lines.append('%s%s_bucket%s %d' % (prefix, name, _format_labels(labels + (('le', bound),)), cumulative))
+		lines.append('%s%s_sum%s %r' % (prefix, name, _format_labels(labels), total))
+		lines.append('%s%s_count%s %d' % (prefix, name, _format_labels(labels), count))
+	for (name, labels), value in counters:
+		if name not in typed:
+			typed.add(name)
+			lines.append('# TYPE %s%s counter' % (prefix, name))
+		lines.append('%s%s%s %r' % (prefix, name, _format_labels(labels), value))
+	for name, func in gauges:
+		lines.append('# TYPE %s%s gauge' % (prefix, name))
+		lines.append('%s%s %r' % (prefix, name, _gauge_value(func)))
+	return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		body = render_prometheus()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def start_http_server(port, host='127.0.0.1'):
+	""" Serve render_prometheus() on http://host:port/ from a daemon thread.
+	"""
+	server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.setDaemon(True)
+	thread.start()
+	return server
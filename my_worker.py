@@ -1,12 +1,23 @@
+import collections
+import itertools
 import logging
+import math
 import threading
 import datetime
+import time
+from multiprocessing.pool import ThreadPool
 
-from binance_util import BinanceClient
-from dal import config, trades_db, get_flat_symbols
-from constants import kRunInterval, kMaxRunInterval
-from telegram_util import notify_user
-from threading_util import requires_lock
+from binance_util import BinanceClient, get_client, get_weight_budget, get_symbol_info_cache
+from dal import config, get_owner, get_tenants
+from constants import kRunInterval, kMaxRunInterval, kUseStreams, kUseUserStream, kFetchThreads, kSchedulerBudgetShare
+from constants import kRestartStatePath, kRestartStateInterval, kRestartStateMaxAge, kMaxOrderAttempts
+from telegram_util import notify_user, notification_batch, PRIORITY_FILL, PRIORITY_ERROR
+from threading_util import state_lock, requires_read_lock
+import restart_util
+import snapshot_util
+import metrics_util
+from scheduler_util import PairScheduler
+from window_util import TradeBuffer
 
 from binance.exceptions import BinanceAPIException
 from requests.exceptions import ReadTimeout
@@ -17,138 +28,615 @@ from format import format_scientific, find_exp
 
 from constants import TRADE_TYPE
 
+class _Account(object):
+	""" A tenant trading through the worker: its client, its balances and their user data stream.
+	"""
+	def __init__(self, tenant, client, balance_cache=None):
+		self.tenant = tenant
+		self.client = client
+		self.balance_cache = balance_cache
+		self.balances = None
+		# Pairs of the open trades of the tenant, as of the last _get_pairs.
+		self.pairs = set()
+
+	@property
+	def chat_id(self):
+		return self.tenant.config.get('chat_id')
+
+	def get_balances(self):
+		""" From the user data stream cache when there is one, from get_account otherwise.
+		"""
+		if self.balance_cache is not None:
+			return self.balance_cache.get_balances()
+		return self.client.get_balances()
+
+	def stop(self):
+		if self.balance_cache is not None:
+			self.balance_cache.stop()
+			self.balance_cache = None
+
 class MyWorker(object):
-	def __init__(self, client):
+	""" Trades for every tenant of dal.get_tenants().
+
+	The market data (tickers, trade windows, streams, symbol filters) is fetched once per pair
+	with the client of the owner and shared by all the tenants, so the cost of a loop grows with
+	the number of distinct pairs. Only the balances and the orders go through the client of each
+	tenant, taking turns so no tenant always waits behind the others.
+	"""
+	def __init__(self, client, use_streams=kUseStreams, clock=time.time, use_user_stream=kUseUserStream, client_factory=get_client,
+			state_path=kRestartStatePath):
+		"""
+		client: client of the owner, also used for all the market data.
+		use_user_stream: keep the balances from the user data stream, see BalanceCache.
+		clock: returns the current time in seconds, e.g. a replay_util.SimClock to replay a recorded market.
+		client_factory: returns the client of the other tenants' keys, e.g. get_client(api_key, secret, user_id).
+		state_path: where start() restores and the running worker saves its state, see get_state. None to start cold.
+		"""
+		self._clock = clock
 		self._thread = threading.Thread(target=self._run)
 		self._c = client
+		self._client_factory = client_factory
 		self.shutdown_event = threading.Event()
+		# Set on shutdown and, in streaming mode, on every market event.
+		self._wake = threading.Event()
+		self._use_streams = use_streams
+		self._stream = None
+		self._use_user_stream = use_user_stream
+		# Set between start() and stop(), the accounts get a user data stream only then.
+		self._running = False
+		# {user_id: _Account}, the owner first.
+		self._accounts = collections.OrderedDict()
+		self._turn = 0
+		# {(user_id, trade key): orders failed in a row}
+		self._order_failures = collections.Counter()
+		self._prices = None
+		self._pool = None
+		self._scheduler = PairScheduler(clock)
+		self._buffers = {}
+		# {pair: server time in ms of its last check}, the next window of the pair reaches back to there.
+		self._checked_at = {}
+		# {pair: time in ms}, the next window of a restored pair reaches back to there.
+		self._catch_up = {}
+		self._state_path = state_path
+		self._restored = False
+		self._next_save = 0
+		self._next_refresh = 0
+		self._server_time_offset = 0
 		self.last_run = None
+		self.last_loop_weight = None
 		self._last_run_error = False
 
 	def start(self):
 		self.last_run = None
 		self._last_run_error = False
+		self._prices = None
+		self._scheduler = PairScheduler(self._clock)
+		self._next_refresh = 0
+		self._restored = self._load_state()
+		self._next_save = self._clock() + kRestartStateInterval
 		self.shutdown_event.clear()
+		self._wake.clear()
+		self._pool = ThreadPool(kFetchThreads)
+		if self._use_streams:
+			# Deferred, the websocket stack is the slowest import of the bot.
+			from stream_util import MarketStream
+			self._stream = MarketStream(self._c, self._wake)
+			self._stream.start()
+		self._running = True
 		self._thread = threading.Thread(target=self._run)
 		self._thread.start()
 
+	def set_client(self, client):
+		""" Switch to the client of the owner's new keys, takes effect from the next loop.
+		"""
+		self._c = client
+
 	def stop(self):
 		self.shutdown_event.set()
+		self._wake.set()
 		self._thread.join()
+		self._pool.close()
+		if self._state_path is not None:
+			self._save_state()
+		if self._stream is not None:
+			self._stream.stop()
+			self._stream = None
+		self._running = False
+		for account in self._accounts.itervalues():
+			account.stop()
+		self._accounts = collections.OrderedDict()
+
+	def run_once(self):
+		""" Run a single loop on the calling thread instead of start(), e.g. to replay a recorded market.
+
+		Returns the time the next loop is due.
+		"""
+		if self._pool is None:
+			self._pool = ThreadPool(kFetchThreads)
+		with notification_batch(self._get_chat_ids()), metrics_util.timer('stage_seconds', stage='loop'):
+			self._run_loop()
+		return self._get_next_run()
+
+	def get_state(self):
+		""" What a restarted worker needs to evaluate right away: the symbol filters, the trade buffers and the schedule.
+
+		Read it on the worker thread or once stopped, the buffers only hold still between loops.
+		"""
+		return {
+			'symbols': get_symbol_info_cache().get_state(),
+			'buffers': self._buffers,
+			'schedule': self._scheduler.get_state(),
+			'server_time_offset': self._server_time_offset,
+		}
+
+	def _load_state(self):
+		""" Restore the state saved before a restart, returns whether there was one.
+		"""
+		if self._state_path is None:
+			return False
+		loaded = restart_util.load_state(self._state_path)
+		if loaded is None:
+			return False
+		state, age = loaded
+		# Filters rarely change, they serve the first loops while _run reloads them.
+		get_symbol_info_cache().set_state(state['symbols'])
+		if age <= kRestartStateMaxAge:
+			self._buffers = state['buffers']
+			self._scheduler.set_state(state['schedule'])
+			self._server_time_offset = state['server_time_offset']
+			# The first window of every pair covers the downtime, e.g. a trailing stop sees the highs it missed.
+			self._catch_up = {pair: x.last_time for pair, x in self._buffers.iteritems() if x.last_time is not None}
+		logging.info('Restored the state of %d seconds ago', age)
+		return True
+
+	def _save_state(self):
+		try:
+			with metrics_util.timer('stage_seconds', stage='save'):
+				restart_util.save_state(self.get_state(), self._state_path)
+		except Exception as e:
+			logging.error('Failed to save the restart state: %s', e)
+
+	def _refresh_symbol_info(self):
+		try:
+			self._c.refresh_symbol_info()
+		except Exception as e:
+			logging.error('Failed to load symbol info: %s', e)
+
+	def get_price_history(self, pair):
+		""" (times in ms, prices) of the buffered trades of pair, None if the worker doesn't poll it.
+
+		Doesn't wait for the loop, so a read while the buffer is being updated may be off by that update.
+		"""
+		buffer = self._buffers.get(pair)
+		if buffer is None or not len(buffer):
+			return None
+		return buffer.history()
+
+	def update_subscriptions(self):
+		""" Follow trades that were just added or removed without waiting for the next loop.
+		"""
+		if self._stream is not None:
+			self._stream.set_pairs(self._get_pairs())
 
 	def _run(self):
 		notify_user("Up!")
+		if self._restored:
+			self._pool.apply_async(self._refresh_symbol_info)
+		else:
+			# Load the filters of all symbols in one request, the loop only reads the cache from here on.
+			self._refresh_symbol_info()
 		sleep_time = kRunInterval
+		next_run = self._clock()
 		while not self.shutdown_event.is_set():
-			logging.debug('loop')
-			try:
-				self._run_loop()
-				sleep_time = kRunInterval
-				if self._last_run_error:
-					self._last_run_error = False
-					notify_user("Completed successful run.")
-			except Exception as e:
-				self._last_run_error = True
-				if isinstance(e, BinanceAPIException) and e.code == -1000:
-					error_str = str(e.message)
-				elif isinstance(e, ReadTimeout):
-					error_str = str(e.message)
-				else:
-					error_str = 'Got %s: %s at:\n%s' % (type(e), e, traceback.format_exc())
-				logging.error(error_str)
-				sleep_time *= 2
-				if sleep_time > kMaxRunInterval:
-					sleep_time = kMaxRunInterval
-				error_str += ('\n\nsleep_time: %s' % sleep_time)
-				notify_user(error_str)
-			finally:
-				self.shutdown_event.wait(sleep_time)
-
-	@requires_lock
+			# Everything a loop notifies goes out as one message once it is done.
+			with notification_batch(self._get_chat_ids()):
+				try:
+					if self._clock() >= next_run:
+						logging.debug('loop')
+						with metrics_util.timer('stage_seconds', stage='loop'):
+							self._run_loop()
+						next_run = self._get_next_run()
+						if self._state_path is not None and self._clock() >= self._next_save:
+							self._save_state()
+							self._next_save = self._clock() + kRestartStateInterval
+					else:
+						self._run_stream_loop()
+					sleep_time = kRunInterval
+					if self._last_run_error:
+						self._last_run_error = False
+						notify_user("Completed successful run.")
+				except Exception as e:
+					self._last_run_error = True
+					if isinstance(e, BinanceAPIException) and e.code == -1000:
+						error_str = str(e.message)
+					elif isinstance(e, ReadTimeout):
+						error_str = str(e.message)
+					else:
+						error_str = 'Got %s: %s at:\n%s' % (type(e), e, traceback.format_exc())
+					logging.error(error_str)
+					sleep_time *= 2
+					if sleep_time > kMaxRunInterval:
+						sleep_time = kMaxRunInterval
+					# The same error repeating every loop is reported once, whatever the sleep time.
+					notify_user(error_str + ('\n\nsleep_time: %s' % sleep_time), PRIORITY_ERROR, key=error_str)
+					next_run = self._clock() + sleep_time
+			self._wake.wait(max(next_run - self._clock(), 0))
+			self._wake.clear()
+
+	def _sync_accounts(self):
+		""" Follow the tenants and their keys, a tenant gets an account once it sent its keys.
+		"""
+		accounts = collections.OrderedDict()
+		for tenant in get_tenants():
+			if tenant is get_owner():
+				client = self._c
+			elif 'api_key' in tenant.config:
+				client = self._client_factory(tenant.config['api_key'], tenant.config['secret'], tenant.user_id)
+			else:
+				continue
+			account = self._accounts.get(tenant.user_id)
+			# The user data stream belongs to the account of the old keys.
+			if account is not None and account.client is not client:
+				account.stop()
+				account = None
+			if account is None:
+				account = _Account(tenant, client)
+			# Started once a loop got its data, so importing and connecting the websocket stack never delays the first one.
+			if account.balance_cache is None and self._running and self._use_user_stream and self._prices is not None:
+				from balance_util import BalanceCache
+				account.balance_cache = BalanceCache(client)
+				account.balance_cache.start()
+			accounts[tenant.user_id] = account
+		for user_id, account in self._accounts.iteritems():
+			if user_id not in accounts:
+				account.stop()
+		self._accounts = accounts
+
+	def _get_accounts(self):
+		""" The accounts, starting at the one whose turn it is to go first, see _evaluate.
+		"""
+		accounts = self._accounts.values()
+		if not accounts:
+			return accounts
+		turn = self._turn % len(accounts)
+		return accounts[turn:] + accounts[:turn]
+
+	def _get_chat_ids(self):
+		return [x.chat_id for x in self._accounts.values() if x.chat_id is not None]
+
+	@requires_read_lock
+	def _get_pairs(self):
+		""" The pairs of the open trades of all the accounts.
+		"""
+		pairs = set()
+		for account in self._accounts.values():
+			account.pairs = account.tenant.trigger_index.get_pairs()
+			pairs |= account.pairs
+		return pairs
+
+	@requires_read_lock
+	def _get_nearest_threshold(self, pair, price):
+		thresholds = [x.tenant.trigger_index.nearest(pair, price) for x in self._accounts.values() if pair in x.pairs]
+		thresholds = [x for x in thresholds if x is not None]
+		return min(thresholds, key=lambda x: abs(x - price)) if thresholds else None
+
+	def _get_next_run(self):
+		""" The earliest of the next due pair and the next balances and tickers refresh.
+		"""
+		next_due = self._scheduler.next_due()
+		if next_due is None:
+			return self._next_refresh
+		return min(next_due, self._next_refresh)
+
+	def get_schedule(self):
+		""" {pair: (seconds until the next check, current interval)}.
+		"""
+		return self._scheduler.get_schedule()
+
 	def _run_loop(self):
 		self.last_run = datetime.datetime.now()
-		balances = self._c.get_balances(get_flat_symbols(trades_db))
-		prices = self._c.get_prices([trade['pair'] for trade in trades_db.itervalues()])
-		server_time = self._c.get_server_time()
-
-		deletes = []
-		updates = {}
-		for key, trade in trades_db.iteritems():
-			if not isinstance(trade, dict):
+		budget = get_weight_budget()
+		weight_before = budget.total
+		self._sync_accounts()
+		pairs = self._get_pairs()
+		if self._stream is not None:
+			self._stream.set_pairs(pairs)
+
+		# Only the pairs whose check is due, balances and tickers are refreshed every kRunInterval.
+		self._scheduler.set_pairs(pairs)
+		self._scheduler.set_max_rate(self._get_max_check_rate(len(pairs), budget))
+		due = self._scheduler.pop_due()
+		# Accounts whose balances failed to load wait for the next regular refresh.
+		refresh = (self._clock() >= self._next_refresh or self._prices is None
+				or any(pair[0] + pair[1] not in self._prices for pair in due)
+				or any(x.balances is not None and any(pair[0] not in x.balances for pair in x.pairs.intersection(due)) for x in self._accounts.values()))
+		try:
+			with metrics_util.timer('stage_seconds', stage='fetch'):
+				prices, windows, spans = self._fetch(due, refresh)
+		except Exception:
+			self._scheduler.retry(due)
+			raise
+
+		self.last_loop_weight = budget.total - weight_before
+		logging.debug('loop checked %d/%d pairs using %d request weight, %d/%d over the last minute',
+				len(due), len(pairs), self.last_loop_weight, budget.used(), budget.limit)
+		try:
+			self._evaluate(due, prices, windows)
+		finally:
+			checks = []
+			for pair in due:
+				price = prices.get(pair[0] + pair[1])
+				# A pair without a ticker or trades, e.g. delisted, is checked again after kMaxPairInterval.
+				threshold = self._get_nearest_threshold(pair, price) if price is not None else None
+				checks.append((pair, price, threshold, windows[pair], spans.get(pair, 2 * kRunInterval)))
+			self._scheduler.reschedule(checks)
+
+	@staticmethod
+	def _get_max_check_rate(pair_count, budget):
+		""" Pair checks per second allowed: at most one per pair every kRunInterval, fewer once the budget runs low.
+		"""
+		max_rate = pair_count / float(kRunInterval)
+		used = budget.used()
+		if used > kSchedulerBudgetShare * budget.limit:
+			max_rate *= kSchedulerBudgetShare * budget.limit / used
+		return max_rate
+
+	def _fetch(self, pairs, refresh):
+		""" Send all the requests of a loop concurrently, returns (prices, windows, {pair: seconds of its window}).
+
+		refresh: also fetch balances, tickers and the server time.
+
+		The aggTrades windows are timed with the server clock offset measured on the last refresh,
+		so they don't have to wait for the server time request.
+		"""
+		server_time = int(self._clock() * 1000) + self._server_time_offset
+		sent_at = self._clock()
+		if refresh:
+			# Everything is fetched unfiltered (same requests) so the handlers can answer from the snapshot.
+			balances = [(x, self._pool.apply_async(x.get_balances)) for x in self._get_accounts()]
+			prices = self._pool.apply_async(self._c.get_prices)
+			new_server_time = self._pool.apply_async(self._c.get_server_time)
+
+		# Per pair trade buffers, refilled with only the aggTrades newer than the last one seen.
+		for pair in set(self._buffers) - self._scheduler.get_pairs():
+			del self._buffers[pair]
+			self._checked_at.pop(pair, None)
+		windows = {}
+		spans = {}
+		for pair in pairs:
+			if self._stream is not None:
+				windows[pair] = self._stream.get_window(pair, filter_threshold=0.8)
+			if windows.get(pair) is not None:
+				self._catch_up.pop(pair, None)
+			else:
+				buffer = self._buffers.setdefault(pair, TradeBuffer())
+				# The buffer pages on from the last check of the pair, a trailing stop must not miss the highs of a long interval.
+				start_time = min(server_time - 2 * kRunInterval * 1000, self._checked_at.get(pair, server_time), self._catch_up.get(pair, server_time))
+				spans[pair] = (server_time - start_time) / 1000.0
+				windows[pair] = (buffer, start_time, self._pool.apply_async(self._c.update_trade_buffer,
+						(buffer, pair, server_time, int(math.ceil(spans[pair])))))
+
+		if refresh:
+			self._prices = prices.get()
+			new_server_time = new_server_time.get()
+			self._server_time_offset = new_server_time - int((sent_at + self._clock()) * 500)
+			self._next_refresh = self._clock() + kRunInterval
+			for account, result in balances:
+				# One tenant's revoked keys must not stop the others from trading.
+				try:
+					account.balances = result.get()
+				except Exception as e:
+					logging.error('Failed to get the balances of %s: %s', account.tenant.user_id, e)
+					error_str = 'Failed to get your balances: %s' % e
+					notify_user(error_str, PRIORITY_ERROR, key=error_str, chat_id=account.chat_id)
+					account.balances = None
+			snapshot_util.publish(prices=self._prices, server_time=new_server_time,
+					balances={x.client: x.balances for x, _ in balances if x.balances is not None})
+		else:
+			self._refresh_cached_balances()
+		# Pairs whose buffer missed trades, e.g. more than kMaxAggTradePages pages of them since the last check.
+		truncated = set()
+		for pair, window in windows.items():
+			if isinstance(window, tuple):
+				buffer, start_time, result = window
+				if not result.get():
+					truncated.add(pair)
+				self._catch_up.pop(pair, None)
+				self._checked_at[pair] = server_time
+				windows[pair] = buffer.window(start_time, filter_threshold=0.8)
+
+		# The last trade of a window that reaches server_time is fresher than the tickers of the last refresh.
+		prices = dict(self._prices)
+		for pair, window in windows.iteritems():
+			if window.last is not None and pair not in truncated:
+				prices[pair[0] + pair[1]] = window.last
+		return prices, windows, spans
+
+	def _refresh_cached_balances(self):
+		for account in self._accounts.values():
+			if account.balance_cache is not None and account.balances is not None:
+				try:
+					account.balances = account.balance_cache.get_balances()
+				except Exception as e:
+					logging.error('Failed to get the balances of %s: %s', account.tenant.user_id, e)
+
+	def _run_stream_loop(self):
+		""" Evaluate only the trades on pairs that got stream events since the last evaluation.
+		"""
+		if self._stream is None or self._prices is None:
+			return
+		pairs = self._stream.pop_dirty()
+		if not pairs:
+			return
+		self._refresh_cached_balances()
+		prices = {}
+		windows = {}
+		for pair in pairs:
+			prices[pair[0] + pair[1]] = self._stream.get_price(pair)
+			windows[pair] = self._stream.get_window(pair, filter_threshold=0.8)
+		open_pairs = self._get_pairs()
+		pairs = [pair for pair in pairs if pair in open_pairs and prices[pair[0] + pair[1]] is not None]
+		self._evaluate(pairs, prices, windows)
+
+	@requires_read_lock
+	def _read_decisions(self, tenant, markets):
+		""" Run the trade book of tenant on markets, returns its (moved, fired, unknown) and copies of those trades.
+
+		Only the trades the trigger index finds may have fired and the trailing stops are evaluated.
+		"""
+		candidates = set()
+		for pair, (price, high, low, _, _, _) in markets.iteritems():
+			candidates.update(tenant.trigger_index.trailing(pair))
+			candidates.update(tenant.trigger_index.fired(pair, max(price, low), min(price, high)))
+		moved, fired, unknown = tenant.trade_book.evaluate(markets, candidates)
+		keys = set(x[0] for x in moved).union(x[0] for x in fired).union(unknown)
+		return moved, fired, unknown, {key: tenant.trades_db[key] for key in keys}
+
+	def _evaluate(self, pairs, prices, windows):
+		started = time.time()
+		# The market inputs are the same for every account, only the free balance differs.
+		markets = {}
+		exps = {}
+		symbol_infos = {}
+		for pair in pairs:
+			current_price = prices.get(''.join(pair))
+			if current_price is None:
+				logging.warning('No price for %s, skipping its trades', '/'.join(pair))
 				continue
-			pair_str = '/'.join(trade['pair'])
-			pair_key = ''.join(trade['pair'])
-			current_price = prices[pair_key]
-			recent_price_max = self._c.get_recent_price(trade['pair'], server_time, 2 * kRunInterval, filter_threshold=0.8, do_max=True) or current_price
-			recent_price_min = self._c.get_recent_price(trade['pair'], server_time, 2 * kRunInterval, filter_threshold=0.8, do_max=False) or current_price
-			exp = find_exp(recent_price_max)
-			balance = balances[trade['pair'][0]]
-			symbol_info = self._c.get_symbol_info(trade['pair'])
+			window = windows[pair]
+			recent_price_max = window.max() or current_price
+			recent_price_min = window.min() or current_price
+			exps[pair] = find_exp(recent_price_max)
+			symbol_info = symbol_infos[pair] = self._c.get_symbol_info(pair)
 			min_q = self._c.get_min_lot_size(symbol_info)
 			price_step = self._c.get_price_step(symbol_info)
-			#viable_q = min(min_q, trade['quantity'])
-			viable_q = min(balance['free'], trade['quantity'])
+			markets[pair] = (current_price, recent_price_max, recent_price_min, min_q, price_step)
+
+		# Once per evaluation that can send orders, so the accounts take turns at going first.
+		if markets:
+			self._turn += 1
+		decisions = []
+		for account in self._get_accounts():
+			if account.balances is None:
+				continue
+			# Pairs added since the last full loop may have no balances yet, they are picked up by the next one.
+			account_markets = {pair: (price, high, low, account.balances[pair[0]]['free'], min_q, price_step)
+					for pair, (price, high, low, min_q, price_step) in markets.iteritems()
+					if pair in account.pairs and pair[0] in account.balances}
+			if account_markets:
+				decisions.append((account,) + self._decide(account, account_markets, exps, symbol_infos))
+
+		metrics_util.observe('stage_seconds', time.time() - started, stage='evaluate')
+
+		# Commit all decisions in one short transaction. Trades changed meanwhile are skipped and
+		# evaluated again by the next loop. Fired trades are removed before their order is sent so
+		# a concurrent /remove can never race an order.
+		with metrics_util.timer('stage_seconds', stage='persist'), state_lock.write():
+			persisted = []
+			for account, updates, fills in decisions:
+				# One transaction per account, a failure midway keeps none of its changes of this loop.
+				with account.tenant.batch():
+					persisted.append((account, [x for x in updates if account.tenant.compare_and_update(x[0], x[1], x[2])],
+							[x for x in fills if account.tenant.compare_and_delete(x[0], x[1])]))
+			decisions = persisted
 
-			# Update trails
-			if trade['type'] == TRADE_TYPE.TRAILING_STOP_LOSS:
-				new_threshold = max(trade['threshold'], (1 - trade['delta']) * recent_price_max)
-				if new_threshold - trade['threshold'] > price_step:
-					notify_user('Updating threshold for %s from %s to %s.' % (pair_str, format_scientific(trade['threshold'], exp), format_scientific(new_threshold, exp)))
-					trade['threshold'] = new_threshold
-					updates[key] = trade
+		# All orders go out concurrently before any notification, a falling market won't wait for us.
+		# They are queued one account at a time so a tenant with many orders can't hold up the others.
+		started = time.time()
+		orders = []
+		for batch in itertools.izip_longest(*[[(account, x) for x in fills if x[2] is not None] for account, _, fills in decisions]):
+			for account, fill in filter(None, batch):
+				orders.append((account, fill, self._pool.apply_async(self._place_order, (account.client, fill[1]['pair'], fill[2], fill[3]))))
+		# A failed order is only the business of its account, the loop and the other accounts go on.
+		failed = set()
+		for account, (key, trade, _, _, _), result in orders:
+			attempt = (account.tenant.user_id, key)
+			try:
+				result.get()
+				self._order_failures.pop(attempt, None)
+			except Exception as e:
+				logging.exception('Order for trade %s of %s failed', key, account.tenant.user_id)
+				failed.add((account, key))
+				self._order_failures[attempt] += 1
+				if self._order_failures[attempt] >= kMaxOrderAttempts:
+					del self._order_failures[attempt]
+					error_str = 'Order for trade %s failed %d times, removed it: %s' % (key, kMaxOrderAttempts, e)
+				else:
+					# Put the trade back so the next loop retries it.
+					with state_lock.write():
+						account.tenant.update_trade(key, trade)
+						account.tenant.trades_db.sync()
+					error_str = 'Order for trade %s failed: %s' % (key, e)
+				notify_user(error_str, PRIORITY_ERROR, key=error_str, chat_id=account.chat_id)
+		if orders:
+			metrics_util.observe('stage_seconds', time.time() - started, stage='order')
+
+		for account, updates, fills in decisions:
+			for _, _, _, message in updates:
+				notify_user(message, chat_id=account.chat_id)
+			for key, trade, side, quantity, message in fills:
+				notify_user(message, PRIORITY_FILL, chat_id=account.chat_id)
+				if side is not None and (account, key) not in failed:
+					notify_user('done!', PRIORITY_FILL, chat_id=account.chat_id)
 
+	def _decide(self, account, markets, exps, symbol_infos):
+		""" The (updates, fills) of the trades of account on markets, built on private copies of the trades.
+		"""
+		moved, fired, unknown, trades = self._read_decisions(account.tenant, markets)
+
+		# Build the messages without holding the lock.
+		updates = []
+		fills = []
+		for key, new_threshold in moved:
+			trade = trades[key]
+			pair = tuple(trade['pair'])
+			exp = exps[pair]
+			message = 'Updating threshold for %s from %s to %s.' % ('/'.join(pair), format_scientific(trade['threshold'], exp), format_scientific(new_threshold, exp))
+			trades[key] = dict(trade, threshold=new_threshold)
+			updates.append((key, trade, trades[key], message))
+
+		for key, quantity in fired:
+			trade = trades[key]
+			pair = tuple(trade['pair'])
+			pair_str = '/'.join(pair)
+			exp = exps[pair]
+			current_price = markets[pair][0]
+			if quantity is not None:
+				# Rounded to the lot step up front so the order can't be rejected by the LOT_SIZE filter.
+				order_quantity = self._c.get_order_quantity(symbol_infos[pair], quantity)
+				if order_quantity is None:
+					# The exchange would reject the order on every loop, removed like a failed order.
+					logging.warning('Trade %s fired below the min lot size of %s', key, pair_str)
+					fills.append((key, trade, None, None, 'Removed trade %s, %s of %s is below the min lot size of %s.' % (
+							key, quantity, pair_str, self._c.get_min_lot_size(symbol_infos[pair]))))
+					continue
+				quantity = order_quantity
 			if trade['type'] == TRADE_TYPE.ALERT_ABOVE:
-					if current_price > trade['threshold']:
-						notify_user('Alert %s is above %s at %s.' % (pair_str, trade['threshold'], format_scientific(trade['threshold'], exp)))
-						deletes.append(key)
+				fills.append((key, trade, None, None, 'Alert %s is above %s at %s.' % (pair_str, trade['threshold'], format_scientific(trade['threshold'], exp))))
 			elif trade['type'] == TRADE_TYPE.ALERT_BELOW:
-					if current_price < trade['threshold']:
-						notify_user('Alert %s is below %s at %s.' % (pair_str, trade['threshold'], format_scientific(trade['threshold'], exp)))
-						deletes.append(key)
+				fills.append((key, trade, None, None, 'Alert %s is below %s at %s.' % (pair_str, trade['threshold'], format_scientific(trade['threshold'], exp))))
 			elif trade['type'] == TRADE_TYPE.BUY_BELOW_AT_MARKET:
-				if recent_price_max < trade['threshold']:
-					notify_user('Buying %s of %s at %s, price is below %s.' % (trade['quantity'], pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp)))
-#order = client.order_market_buy(
-#		symbol='BNBBTC',
-#		quantity=100)
-#
-#order = client.order_market_sell(
-#		symbol='BNBBTC',
-#		quantity=100)
-					order = self._c.create_order(
-						pair=trade['pair'],
-						side=BinanceClient.SIDE_BUY,
-						type=BinanceClient.ORDER_TYPE_MARKET,
-						quantity=trade['quantity'])
-					deletes.append(key)
-					notify_user('done!')
+				fills.append((key, trade, BinanceClient.SIDE_BUY, quantity, 'Buying %s of %s at %s, price is below %s.' % (quantity, pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp))))
 			elif trade['type'] == TRADE_TYPE.SELL_ABOVE_AT_MARKET:
-				if recent_price_min > trade['threshold'] and viable_q >= min_q:
-					notify_user('Selling %s of %s at %s, price is above %s.' % (viable_q, pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp)))
-					order = self._c.create_order(
-						pair=trade['pair'],
-						side=BinanceClient.SIDE_SELL,
-						type=BinanceClient.ORDER_TYPE_MARKET,
-						quantity=viable_q)
-					deletes.append(key)
-					notify_user('done!')
-			elif trade['type'] in (TRADE_TYPE.SELL_BELOW_AT_MARKET, TRADE_TYPE.TRAILING_STOP_LOSS):
-				if recent_price_max < trade['threshold'] and viable_q >= min_q:
-					notify_user('Selling %s of %s at %s, price is below %s.' % (viable_q, pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp)))
-					order = self._c.create_order(
-						pair=trade['pair'],
-						side=BinanceClient.SIDE_SELL,
-						type=BinanceClient.ORDER_TYPE_MARKET,
-						quantity=viable_q)
-					deletes.append(key)
-					notify_user('done!')
+				fills.append((key, trade, BinanceClient.SIDE_SELL, quantity, 'Selling %s of %s at %s, price is above %s.' % (quantity, pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp))))
 			else:
-				notify_user("Urecognized trade type: %s" % trade['type'])
+				fills.append((key, trade, BinanceClient.SIDE_SELL, quantity, 'Selling %s of %s at %s, price is below %s.' % (quantity, pair_str, format_scientific(current_price, exp), format_scientific(trade['threshold'], exp))))
+
+		for key in unknown:
+			notify_user("Urecognized trade type: %s" % trades[key]['type'], chat_id=account.chat_id)
+		return updates, fills
 
-		trades_db.update(updates)
-		for key in deletes:
-			del trades_db[key]
-		trades_db.sync()
+	def _place_order(self, client, pair, side, quantity):
+		""" Send a market order and record how long the exchange took to acknowledge it.
+		"""
+		started = time.time()
+		order = client.create_order(
+			pair=pair,
+			side=side,
+			type=BinanceClient.ORDER_TYPE_MARKET,
+			quantity=quantity)
+		metrics_util.observe('order_ack_seconds', time.time() - started)
+		return order
 
 _glb_instance = None
 
@@ -160,7 +648,7 @@ def get_instance():
 	if 'api_key' not in config:
 		raise Exception('can\'t find api key')
 
-	client = BinanceClient(config['api_key'], config['secret'])
+	client = get_client(config['api_key'], config['secret'])
 	_glb_instance = MyWorker(client)
 	return _glb_instance
 
@@ -0,0 +1,180 @@
+import bisect
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+from binance.client import Client as _Client
+
+from binance_util import BinanceClient, get_request_weight
+
+class SimClock(object):
+	""" Clock that only moves when told to, pass it as the clock of MyWorker and ReplayClient.
+	"""
+	def __init__(self, now=0.0):
+		self._now = float(now)
+
+	def __call__(self):
+		return self._now
+
+	def set(self, now):
+		self._now = float(now)
+
+	def advance(self, seconds):
+		self._now += seconds
+
+def _api_path(client, uri):
+	# https://api.binance.com/api/v1/ticker/allPrices -> ticker/allPrices
+	return uri[len(client.API_URL) + 1:].split('/', 1)[1]
+
+class RecordingClient(BinanceClient):
+	""" BinanceClient that appends every exchange response to path, one json record per line.
+
+	e.g. my_worker.get_instance().set_client(RecordingClient(key, secret, 'data/recording.jsonl'))
+	"""
+	def __init__(self, api_key, api_secret, path):
+		self._record = open(path, 'a')
+		self._record_lock = threading.Lock()
+		BinanceClient.__init__(self, api_key, api_secret)
+
+	def _request(self, method, uri, signed, force_params=False, **kwargs):
+		params = dict(kwargs.get('data') or {})
+		response = BinanceClient._request(self, method, uri, signed, force_params, **kwargs)
+		params.pop('timestamp', None)
+		params.pop('signature', None)
+		record = {'time': int(time.time() * 1000), 'method': method, 'path': _api_path(self, uri), 'params': params, 'response': response}
+		with self._record_lock:
+			self._record.write(json.dumps(record) + '\n')
+			self._record.flush()
+		return response
+
+class ReplayClient(BinanceClient):
+	""" BinanceClient that answers from recorded responses instead of the exchange, as of clock().
+
+	aggTrades are merged per symbol and every query is answered from them, other endpoints get the
+	last response recorded at or before the current time. Orders are kept in orders and acked.
+	Requests are counted in calls and weight, but never throttled by the request weight budget.
+	"""
+	def __init__(self, records, clock):
+		"""
+		records: path of a RecordingClient file or the records themselves.
+		clock: returns the current time in seconds, e.g. a SimClock.
+		"""
+		if isinstance(records, basestring):
+			with open(records) as f:
+				records = [json.loads(line) for line in f if line.strip()]
+		self._clock = clock
+		self._responses = collections.defaultdict(list)
+		trades = collections.defaultdict(dict)
+		for record in sorted(records, key=lambda x: x['time']):
+			if record['path'] == 'aggTrades':
+				trades[record['params']['symbol']].update((x['a'], x) for x in record['response'])
+			else:
+				self._responses[record['path']].append((record['time'], record['response']))
+		self._trades = {}
+		for symbol, by_id in trades.iteritems():
+			ids = sorted(by_id)
+			trades = [by_id[x] for x in ids]
+			self._trades[symbol] = (np.array(ids, dtype=np.int64), np.array([x['T'] for x in trades], dtype=np.int64), trades)
+		self._response_times = {x: [y[0] for y in responses] for x, responses in self._responses.iteritems()}
+		self._lock = threading.Lock()
+		self.calls = collections.Counter()
+		self.weight = 0
+		self.orders = []
+		BinanceClient.__init__(self, 'replay', 'replay')
+
+	def _request_api(self, method, path, *args, **kwargs):
+		with self._lock:
+			self.calls[path] += 1
+			self.weight += get_request_weight(path)
+		# Skips BinanceClient._request_api, a replay can't get the IP banned.
+		return _Client._request_api(self, method, path, *args, **kwargs)
+
+	def _request(self, method, uri, signed, force_params=False, **kwargs):
+		path = _api_path(self, uri)
+		params = kwargs.get('data') or {}
+		now = int(self._clock() * 1000)
+		if path == 'ping':
+			return {}
+		if path == 'time':
+			return {'serverTime': now}
+		if path == 'aggTrades':
+			return self._agg_trades(now, **params)
+		if path == 'userDataStream':
+			return {'listenKey': 'replay'} if method == 'post' else {}
+		if path in ('order', 'order/test') and method == 'post':
+			with self._lock:
+				self.orders.append(dict(params, time=now, test=path == 'order/test'))
+				order_id = len(self.orders)
+			return {'symbol': params['symbol'], 'orderId': order_id, 'transactTime': now}
+		if path not in self._responses:
+			raise Exception('No recorded response for: %s' % path)
+		# The last response at or before now, the first one before the recording started.
+		i = bisect.bisect_right(self._response_times[path], now)
+		return self._responses[path][max(i - 1, 0)][1]
+
+	def _agg_trades(self, now, symbol, fromId=None, startTime=None, endTime=None, limit=500):
+		if symbol not in self._trades:
+			return []
+		ids, times, trades = self._trades[symbol]
+		# Nothing after now has happened yet.
+		last = np.searchsorted(times, min(now, endTime) if endTime is not None else now, side='right')
+		if fromId is not None:
+			first = np.searchsorted(ids, fromId)
+		elif startTime is not None:
+			first = np.searchsorted(times, startTime)
+		else:
+			first = max(last - limit, 0)
+		return trades[first:min(last, first + limit)]
+
+def synthetic_market(pairs, start, duration, trades_per_second=2.0, volatility=1e-3, seed=0):
+	""" Records of a random walk market over the given pairs, for ReplayClient.
+
+	pairs: e.g. (('LTC', 'BTC'),), every base asset gets a balance of 1000.
+	start, duration: seconds, the market starts at start and lasts duration.
+	volatility: standard deviation of the relative price change per second.
+
+	Returns (records, series) where series is {symbol: (times in ms, prices)} of every trade.
+	"""
+	random = np.random.RandomState(seed)
+	start_ms = int(start * 1000)
+	records = []
+	series = {}
+	symbols = []
+	trade_id = 0
+	for base, quote in pairs:
+		symbol = base + quote
+		count = random.poisson(trades_per_second * duration) + 1
+		times = np.sort(random.randint(0, int(duration * 1000), count)) + start_ms
+		steps = np.diff(np.concatenate(([start_ms], times))) / 1000.0
+		prices = random.uniform(0.001, 0.1) * np.exp(np.cumsum(random.normal(0, volatility * np.sqrt(steps))))
+		prices = np.round(prices, 8)
+		series[symbol] = (times, prices)
+		trades = [{'a': trade_id + i, 'p': '%.8f' % p, 'q': '%.3f' % q, 'T': int(t), 'm': False, 'M': True}
+				for i, (t, p, q) in enumerate(zip(times, prices, random.exponential(1.0, count) + 0.001))]
+		trade_id += count
+		records.append({'time': start_ms, 'method': 'get', 'path': 'aggTrades', 'params': {'symbol': symbol}, 'response': trades})
+		symbols.append({
+			'symbol': symbol,
+			'status': 'TRADING',
+			'baseAsset': base,
+			'quoteAsset': quote,
+			'filters': [
+				{'filterType': 'PRICE_FILTER', 'minPrice': '0.00000001', 'maxPrice': '100000.00000000', 'tickSize': '0.00000001'},
+				{'filterType': 'LOT_SIZE', 'minQty': '0.00100000', 'maxQty': '100000.00000000', 'stepSize': '0.00100000'},
+			],
+		})
+	records.append({'time': start_ms, 'method': 'get', 'path': 'exchangeInfo', 'params': {}, 'response': {'symbols': symbols}})
+	assets = set(x for pair in pairs for x in pair)
+	balances = [{'asset': x, 'free': '1000.00000000', 'locked': '0.00000000'} for x in sorted(assets)]
+	records.append({'time': start_ms, 'method': 'get', 'path': 'account', 'params': {}, 'response': {'balances': balances}})
+	# One ticker snapshot per second, with the last trade price of every symbol.
+	for second in xrange(int(duration) + 1):
+		at = start_ms + second * 1000
+		tickers = []
+		for symbol, (times, prices) in sorted(series.iteritems()):
+			i = max(np.searchsorted(times, at, side='right') - 1, 0)
+			tickers.append({'symbol': symbol, 'price': '%.8f' % prices[i]})
+		records.append({'time': at, 'method': 'get', 'path': 'ticker/allPrices', 'params': {}, 'response': tickers})
+	return records, series
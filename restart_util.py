@@ -0,0 +1,36 @@
+import cPickle as _pickle
+import logging
+import os
+import time
+
+from constants import kRestartStatePath
+
+# Bumped whenever the layout of the state changes, files of other versions are ignored.
+_VERSION = 1
+
+def save_state(state, path=kRestartStatePath):
+	""" Pickle state to path, e.g. MyWorker.get_state().
+
+	Written to a temporary file renamed over path, so a crash while saving keeps the previous state.
+	"""
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		_pickle.dump((_VERSION, time.time(), state), f, _pickle.HIGHEST_PROTOCOL)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmp_path, path)
+
+def load_state(path=kRestartStatePath):
+	""" (state, age in seconds) of the last save_state, None if there is no readable one.
+	"""
+	try:
+		with open(path, 'rb') as f:
+			version, saved_at, state = _pickle.load(f)
+	except IOError:
+		return None
+	except Exception as e:
+		logging.warning('Ignoring unreadable restart state %s: %s', path, e)
+		return None
+	if version != _VERSION:
+		return None
+	return state, time.time() - saved_at
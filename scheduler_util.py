@@ -0,0 +1,161 @@
+import heapq
+import threading
+import time
+
+from constants import kMinPairInterval, kMaxPairInterval, kSchedulerSafety, kMinVolatility
+
+def get_poll_interval(distance, volatility):
+	""" Seconds until a pair should be checked again.
+
+	distance: relative distance of the price to the nearest threshold, e.g. 0.01 for 1%.
+	volatility: relative price change per second.
+	"""
+	volatility = max(volatility, kMinVolatility)
+	return min(max(kSchedulerSafety * distance / volatility, kMinPairInterval), kMaxPairInterval)
+
+class PairScheduler(object):
+	""" Priority queue of the next time every pair is due for a check.
+
+	With a max rate set, intervals are raised to a common floor whenever the checks the pairs ask for
+	add up to more than max_rate per second, so pairs polled faster than kRunInterval are paid for by
+	the ones polled slower.
+	"""
+	def __init__(self, clock=time.time):
+		"""
+		clock: returns the current time in seconds, e.g. a replay_util.SimClock.
+		"""
+		self._clock = clock
+		self._heap = []
+		self._due = {}
+		self._intervals = {}
+		# {pair: checks per second it asks for} and their sum.
+		self._rates = {}
+		self._rate = 0.0
+		self._max_rate = None
+		self._lock = threading.Lock()
+
+	def set_max_rate(self, max_rate):
+		""" Most checks per second of all the pairs together, None for no limit.
+		"""
+		with self._lock:
+			self._max_rate = max_rate
+
+	def set_pairs(self, pairs):
+		""" New pairs are due right away, removed pairs are dropped.
+		"""
+		now = self._clock()
+		with self._lock:
+			for pair in set(self._due) - set(pairs):
+				del self._due[pair]
+				self._intervals.pop(pair, None)
+				self._rate -= self._rates.pop(pair, 0.0)
+			for pair in set(pairs) - set(self._due):
+				self._push(pair, now)
+
+	def pop_due(self, now=None):
+		""" Pairs whose check time has come, they stay out of the queue until rescheduled.
+		"""
+		now = self._clock() if now is None else now
+		due = set()
+		with self._lock:
+			while self._heap and self._heap[0][0] <= now:
+				at, pair = heapq.heappop(self._heap)
+				# Skip entries of removed or rescheduled pairs.
+				if self._due.get(pair) == at:
+					due.add(pair)
+					self._due[pair] = None
+		return due
+
+	def get_pairs(self):
+		with self._lock:
+			return set(self._due)
+
+	def next_due(self):
+		""" Time of the earliest check, None if there are no scheduled pairs.
+		"""
+		with self._lock:
+			while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+				heapq.heappop(self._heap)
+			return self._heap[0][0] if self._heap else None
+
+	def reschedule(self, checks):
+		""" Schedule the next check of the pairs of a loop from their distance to threshold and the spread of window.
+
+		checks: (pair, price, threshold, window, window seconds) of every pair just checked.
+		"""
+		intervals = {}
+		for pair, price, threshold, window, window_seconds in checks:
+			if threshold is None or not price:
+				intervals[pair] = kMaxPairInterval
+			else:
+				low, high = window.min(), window.max()
+				volatility = (high - low) / price / window_seconds if len(window) else 0
+				intervals[pair] = get_poll_interval(abs(price - threshold) / price, volatility)
+		now = self._clock()
+		with self._lock:
+			intervals = {x: y for x, y in intervals.iteritems() if x in self._due}
+			for pair, interval in intervals.iteritems():
+				self._rate += 1.0 / interval - self._rates.get(pair, 0.0)
+				self._rates[pair] = 1.0 / interval
+			floor = self._get_floor()
+			for pair, interval in intervals.iteritems():
+				self._intervals[pair] = max(interval, floor)
+				self._push(pair, now + self._intervals[pair])
+
+	def _get_floor(self):
+		""" Shortest interval that keeps the checks within max_rate, 0 if they already are.
+		"""
+		if not self._max_rate or not self._due:
+			return 0
+		# Pairs not checked yet, e.g. restored ones, count as their share of max_rate.
+		unrated = (len(self._due) - len(self._rates)) * self._max_rate / len(self._due)
+		if self._rate + unrated <= self._max_rate:
+			return 0
+		# Raise the k shortest intervals to k / (what the longer ones leave of max_rate), for the smallest k that fits.
+		intervals = sorted(1.0 / x for x in self._rates.itervalues())
+		tail = self._rate
+		floor = 0
+		for k, interval in enumerate(intervals, 1):
+			tail -= 1.0 / interval
+			room = self._max_rate - unrated - tail
+			if room > 0:
+				floor = k / room
+				if k == len(intervals) or floor <= intervals[k]:
+					break
+		return floor
+
+	def retry(self, pairs):
+		""" Make pairs whose check failed due again right away.
+		"""
+		now = self._clock()
+		with self._lock:
+			for pair in pairs:
+				if pair in self._due:
+					self._push(pair, now)
+
+	def get_state(self):
+		""" {pair: (time of the next check, current interval)}, the time is None while a check is in flight.
+		"""
+		with self._lock:
+			return {pair: (at, self._intervals.get(pair)) for pair, at in self._due.iteritems()}
+
+	def set_state(self, state):
+		""" Restore a get_state(), e.g. of the worker before a restart. Checks in flight are due right away.
+		"""
+		now = self._clock()
+		with self._lock:
+			for pair, (at, interval) in state.iteritems():
+				if interval is not None:
+					self._intervals[pair] = interval
+				self._push(pair, now if at is None else at)
+
+	def get_schedule(self):
+		""" {pair: (seconds until the next check, current interval)}.
+		"""
+		now = self._clock()
+		with self._lock:
+			return {pair: (max(at - now, 0) if at is not None else 0, self._intervals.get(pair)) for pair, at in self._due.iteritems()}
+
+	def _push(self, pair, at):
+		self._due[pair] = at
+		heapq.heappush(self._heap, (at, pair))
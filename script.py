@@ -5,22 +5,31 @@ import logging
 from telegram_util import get_updater
 from handlers import register_handlers
 from my_worker import get_instance as get_worker
-from dal import trades_db, config
+from dal import get_tenants
+from constants import kMetricsPort
+import metrics_util
+import chart_util
 
 def start():
 	logging.basicConfig(filename='log.txt', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+	# Forked before any thread of the bot is started.
+	chart_util.get_renderer().start()
 	register_handlers(get_updater().dispatcher)
 	get_worker().start()
 	get_updater().start_polling()
+	if kMetricsPort is not None:
+		metrics_util.start_http_server(kMetricsPort)
 
 	logging.info("Up!")
 
 def stop():
 	get_worker().stop()
 	get_updater().stop()
+	chart_util.get_renderer().stop()
 
-	trades_db.sync()
-	config.sync()
+	for tenant in get_tenants():
+		tenant.trades_db.sync()
+		tenant.config.sync()
 	logging.info("Down!")
 
 def parse_args():
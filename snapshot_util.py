@@ -0,0 +1,80 @@
+import threading
+import time
+
+from constants import kSnapshotMaxAge
+
+class MarketSnapshot(object):
+	""" Immutable view of the exchange: tickers, balances and server time, each with the time it was fetched.
+
+	balances are per account, {client: balances} of the clients the worker trades with.
+
+	Never modified once published, readers may keep a reference without holding any lock.
+	"""
+	_FIELDS = ('prices', 'balances', 'server_time')
+
+	def __init__(self, **kwargs):
+		for field in self._FIELDS:
+			setattr(self, field, kwargs.get(field))
+			setattr(self, field + '_at', kwargs.get(field + '_at', 0))
+
+	def replace(self, **kwargs):
+		""" A copy with the given fields replaced and stamped with the current time.
+		"""
+		now = time.time()
+		values = {}
+		for field in self._FIELDS:
+			if field in kwargs:
+				values[field] = kwargs[field]
+				values[field + '_at'] = now
+			else:
+				values[field] = getattr(self, field)
+				values[field + '_at'] = getattr(self, field + '_at')
+		return MarketSnapshot(**values)
+
+	def age(self, field):
+		return time.time() - getattr(self, field + '_at')
+
+	def is_fresh(self, field, max_age):
+		return getattr(self, field) is not None and self.age(field) <= max_age
+
+_glb_snapshot = MarketSnapshot()
+_glb_lock = threading.Lock()
+
+def get_snapshot():
+	return _glb_snapshot
+
+def publish(**kwargs):
+	""" Publish fresh data, e.g. publish(prices=prices, balances={client: balances}).
+	"""
+	global _glb_snapshot
+	with _glb_lock:
+		_glb_snapshot = _glb_snapshot.replace(**kwargs)
+
+def get_prices(client, pairs=None, max_age=kSnapshotMaxAge):
+	""" Like client.get_prices but served from the snapshot unless it is older than max_age seconds.
+	"""
+	snapshot = get_snapshot()
+	if snapshot.is_fresh('prices', max_age):
+		prices = snapshot.prices
+	else:
+		prices = client.get_prices()
+		publish(prices=prices)
+	if pairs:
+		pairs = set([pair[0] + pair[1] for pair in pairs])
+		prices = {x: y for x, y in prices.iteritems() if x in pairs}
+	return prices
+
+def get_balances(client, symbols=None, max_age=kSnapshotMaxAge):
+	""" Like client.get_balances but served from the snapshot unless it is older than max_age seconds.
+
+	Accounts missing from the snapshot are fetched without publishing, so the accounts of the
+	last refresh keep their timestamp.
+	"""
+	snapshot = get_snapshot()
+	if snapshot.is_fresh('balances', max_age) and client in snapshot.balances:
+		balances = snapshot.balances[client]
+	else:
+		balances = client.get_balances()
+	if symbols is None:
+		return balances
+	return {x: y for x, y in balances.iteritems() if x in symbols}
@@ -0,0 +1,123 @@
+import collections
+import threading
+
+from constants import kStatusPageLength
+from format import find_exp, format_balances, format_pair_header, format_trade
+
+# Room a page keeps per pair for its header line (price and polling) and the balances of its two assets.
+_PAIR_OVERHEAD = 128
+
+class StatusView(object):
+	""" The /status pages of one tenant.
+
+	The trades are grouped per pair and rendered once, then kept until the trades of the pair
+	change or its price moves to another exponent. Pages are laid out over the rendered lines when
+	the trades change, so a page only formats the few pairs it shows, whatever the size of the book.
+	"""
+	def __init__(self, page_length=kStatusPageLength):
+		self._page_length = page_length
+		self._version = None
+		# Sorted pairs and {pair: trades sorted by threshold}.
+		self._pairs = []
+		self._trades = {}
+		# {(pair, use_repr): (exp, lines)}
+		self._lines = {}
+		# {(pair filter, use_repr): pages}, a page being a list of (pair, first line, end line).
+		self._layouts = {}
+		self._lock = threading.Lock()
+
+	def is_current(self, version):
+		return version == self._version
+
+	def update(self, version, trades):
+		""" Show the trades of a version of the book, e.g. update(*tenant.get_trades()).
+		"""
+		grouped = collections.defaultdict(list)
+		for trade in trades.itervalues():
+			grouped[tuple(trade['pair'])].append(trade)
+		for pair_trades in grouped.itervalues():
+			pair_trades.sort(key=lambda trade: trade['threshold'])
+		with self._lock:
+			# A slower reader of an older version must not replace a newer one.
+			if self._version is not None and version < self._version:
+				return
+			# Only the pairs whose trades changed are rendered again.
+			self._lines = {key: value for key, value in self._lines.iteritems() if grouped.get(key[0]) == self._trades.get(key[0])}
+			self._trades = dict(grouped)
+			self._pairs = sorted(grouped)
+			self._layouts = {}
+			self._version = version
+
+	def render(self, page, prices, balances, schedule=None, pair_filter=None, use_repr=False, usd_prices=None):
+		""" (text, page, page count) of a page, the page being clamped to the existing ones.
+
+		prices: {symbol: price}, balances: {asset: balance}, schedule: MyWorker.get_schedule().
+		pair_filter: only the pairs of a symbol (LTCBTC) or an asset (LTC).
+		usd_prices: {asset: USD price}, adds the USD value of the balances and of the whole portfolio.
+		"""
+		schedule = schedule or {}
+		with self._lock:
+			key = (pair_filter, use_repr)
+			if key not in self._layouts:
+				self._layouts[key] = self._layout(prices, pair_filter, use_repr)
+			pages = self._layouts[key]
+			if not pages:
+				return 'No open trades.', 0, 0
+			page = min(max(page, 0), len(pages) - 1)
+			text = ['Status (page %d/%d):' % (page + 1, len(pages))]
+			assets = set()
+			for pair, first, end in pages[page]:
+				text.append(format_pair_header(pair, prices.get(pair[0] + pair[1]), schedule.get(pair)))
+				text.extend(self._get_lines(pair, use_repr, prices)[first:end])
+				assets.update(pair)
+		text.append('\nBalances:\n%s' % format_balances({x: y for x, y in balances.iteritems() if x in assets}, usd_prices))
+		if usd_prices:
+			total = sum((y['free'] + y['locked']) * usd_prices[x] for x, y in balances.iteritems() if x in usd_prices)
+			text.append('Portfolio: $%.2f' % total)
+		return '\n'.join(text), page, len(pages)
+
+	def _get_lines(self, pair, use_repr, prices):
+		trades = self._trades[pair]
+		exp = find_exp(prices.get(pair[0] + pair[1]) or trades[0]['threshold'])
+		lines = self._lines.get((pair, use_repr))
+		if lines is None or lines[0] != exp:
+			lines = self._lines[(pair, use_repr)] = (exp, [format_trade(x, exp, use_repr) for x in trades])
+		return lines[1]
+
+	def _layout(self, prices, pair_filter, use_repr):
+		pages = []
+		page = []
+		length = 0
+		for pair in self._pairs:
+			if pair_filter is not None and pair_filter not in (pair[0] + pair[1], pair[0], pair[1]):
+				continue
+			lines = self._get_lines(pair, use_repr, prices)
+			first = 0
+			length += _PAIR_OVERHEAD
+			for i, line in enumerate(lines):
+				# A pair too long for a page goes on over the next ones, repeating its header.
+				if length + len(line) + 1 > self._page_length and (page or i > first):
+					if i > first:
+						page.append((pair, first, i))
+					pages.append(page)
+					page, length, first = [], _PAIR_OVERHEAD, i
+				length += len(line) + 1
+			page.append((pair, first, len(lines)))
+		if page:
+			pages.append(page)
+		return pages
+
+# {user_id: StatusView}
+_glb_views = {}
+_glb_views_lock = threading.Lock()
+
+def get_view(tenant):
+	""" The StatusView of tenant, up to date with its trades.
+	"""
+	with _glb_views_lock:
+		if tenant.user_id not in _glb_views:
+			_glb_views[tenant.user_id] = StatusView()
+		view = _glb_views[tenant.user_id]
+	if not view.is_current(tenant.get_trades_version()):
+		view.update(*tenant.get_trades())
+	return view
@@ -0,0 +1,191 @@
+import contextlib
+import cPickle as _pickle
+import glob
+import logging
+import shelve as _shelve
+import sqlite3
+import threading
+
+class ShelveTable(_shelve.DbfilenameShelf):
+	""" The original shelve storage with the interface of SqliteTable.
+	"""
+	def __init__(self, path, columns=None):
+		_shelve.DbfilenameShelf.__init__(self, path)
+		self._columns = columns or {}
+
+	def find(self, **columns):
+		keys = set()
+		for key, value in self.iteritems():
+			if all(_column_value(self._columns[name], value) == x for name, x in columns.iteritems()):
+				keys.add(key)
+		return keys
+
+	@contextlib.contextmanager
+	def batch(self):
+		yield self
+		self.sync()
+
+class SqliteStore(object):
+	""" A single sqlite file in WAL mode holding any number of tables.
+	"""
+	def __init__(self, path):
+		self._conn = sqlite3.connect(path, check_same_thread=False)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		# WAL stays consistent on power loss with NORMAL, only the last transactions may be lost.
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)')
+		self._conn.commit()
+		self.lock = threading.RLock()
+
+	def open_table(self, name, columns=None, shelve_path=None):
+		"""
+		columns: indexed columns, {name: function from value to column value}.
+		shelve_path: shelve file to import into the table the first time it is opened.
+		"""
+		table = SqliteTable(self, name, columns)
+		if shelve_path is not None:
+			self._migrate(table, shelve_path)
+		return table
+
+	def execute(self, sql, args=()):
+		with self.lock:
+			return self._conn.execute(sql, args).fetchall()
+
+	def commit(self):
+		with self.lock:
+			self._conn.commit()
+
+	def rollback(self):
+		with self.lock:
+			self._conn.rollback()
+
+	def _migrate(self, table, shelve_path):
+		migration = 'shelve:%s' % shelve_path
+		with self.lock:
+			if self.execute('SELECT name FROM migrations WHERE name = ?', (migration,)):
+				return
+			# dbm backends may add a suffix to the file name.
+			if glob.glob(shelve_path + '*'):
+				old = _shelve.open(shelve_path, flag='r')
+				try:
+					for key, value in old.iteritems():
+						table[key] = value
+				finally:
+					old.close()
+				logging.info('Migrated %s into %s', shelve_path, table.name)
+			self.execute('INSERT INTO migrations (name) VALUES (?)', (migration,))
+			self.commit()
+
+class SqliteTable(object):
+	""" Dict like table of pickled values, a drop-in replacement for a shelve.
+
+	Every row is cached in memory in its pickled form, so reads never hit the disk and writes of
+	unchanged values are skipped. Writes are committed on sync() or at the end of batch().
+	"""
+	def __init__(self, store, name, columns=None):
+		self.name = name
+		self._store = store
+		self._columns = columns or {}
+		column_defs = ''.join(', %s TEXT' % x for x in sorted(self._columns))
+		store.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB NOT NULL%s)' % (name, column_defs))
+		for column in self._columns:
+			store.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (name, column, name, column))
+		store.commit()
+		self._rows = self._load()
+
+	def _load(self):
+		return {str(key): str(value) for key, value in self._store.execute('SELECT key, value FROM %s' % self.name)}
+
+	def __len__(self):
+		return len(self._rows)
+
+	def __contains__(self, key):
+		return key in self._rows
+
+	def __iter__(self):
+		return iter(list(self._rows))
+
+	def __getitem__(self, key):
+		return _pickle.loads(self._rows[key])
+
+	def __setitem__(self, key, value):
+		blob = _pickle.dumps(value, _pickle.HIGHEST_PROTOCOL)
+		if self._rows.get(key) == blob:
+			return
+		names = sorted(self._columns)
+		sql = 'INSERT OR REPLACE INTO %s (key, value%s) VALUES (?, ?%s)' % (
+				self.name, ''.join(', ' + x for x in names), ', ?' * len(names))
+		args = [key, sqlite3.Binary(blob)] + [_column_value(self._columns[x], value) for x in names]
+		with self._store.lock:
+			self._store.execute(sql, args)
+			self._rows[key] = blob
+
+	def __delitem__(self, key):
+		with self._store.lock:
+			if key not in self._rows:
+				raise KeyError(key)
+			self._store.execute('DELETE FROM %s WHERE key = ?' % self.name, (key,))
+			del self._rows[key]
+
+	def get(self, key, default=None):
+		if key in self._rows:
+			return self[key]
+		return default
+
+	def keys(self):
+		return list(self._rows)
+
+	def iterkeys(self):
+		return iter(self.keys())
+
+	def itervalues(self):
+		for key in self.keys():
+			yield self[key]
+
+	def values(self):
+		return list(self.itervalues())
+
+	def iteritems(self):
+		for key in self.keys():
+			yield key, self[key]
+
+	def items(self):
+		return list(self.iteritems())
+
+	def update(self, other):
+		for key, value in other.iteritems():
+			self[key] = value
+
+	def find(self, **columns):
+		""" Keys of the rows matching all the given indexed columns, e.g. find(pair='LTCBTC').
+		"""
+		names = sorted(columns)
+		where = ' AND '.join('%s = ?' % x for x in names)
+		rows = self._store.execute('SELECT key FROM %s WHERE %s' % (self.name, where), [columns[x] for x in names])
+		return set(str(x[0]) for x in rows)
+
+	def sync(self):
+		self._store.commit()
+
+	def close(self):
+		self.sync()
+
+	@contextlib.contextmanager
+	def batch(self):
+		""" Apply all the writes in the block as a single transaction.
+		"""
+		with self._store.lock:
+			try:
+				yield self
+			except:
+				self._store.rollback()
+				# Reload the cache from the rolled back table.
+				self._rows = self._load()
+				raise
+			self._store.commit()
+
+def _column_value(column, value):
+	try:
+		return column(value)
+	except (KeyError, TypeError):
+		return None
@@ -0,0 +1,141 @@
+import collections
+import json
+import logging
+import threading
+
+from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
+from binance.websockets import BinanceSocketManager
+from twisted.internet import reactor
+
+from window_util import MarketWindow
+from constants import kRunInterval, kStreamUrl
+
+class MarketStream(object):
+	""" Keeps the recent trades and last price of a set of pairs from the aggTrade and miniTicker streams.
+
+	Every event marks its pair as dirty and sets wake so the consumer can evaluate it right away.
+	All twisted calls are made on the reactor thread, the rest of the methods are thread safe.
+	"""
+	def __init__(self, client, wake, url=kStreamUrl, window=2 * kRunInterval, record_path=None):
+		self._manager = BinanceSocketManager(client)
+		self._manager.STREAM_URL = url
+		self._manager.setDaemon(True)
+		self._wake = wake
+		self._window_ms = window * 1000
+		self._record = open(record_path, 'a') if record_path else None
+		self._lock = threading.Lock()
+		self._conn_key = None
+		self._pairs = {}
+		self._trades = {}
+		self._prices = {}
+		self._event_times = {}
+		self._dirty = set()
+
+	def start(self):
+		# Returns right away if another stream already runs the reactor.
+		self._manager.start()
+
+	def stop(self):
+		self.set_pairs(())
+		reactor.callFromThread(self._manager.close)
+
+	def set_pairs(self, pairs):
+		""" Subscribe to exactly the given pairs, e.g. (('LTC', 'BTC'),).
+		"""
+		pairs = {pair[0] + pair[1]: tuple(pair) for pair in pairs}
+		with self._lock:
+			if set(pairs) == set(self._pairs):
+				return
+			for symbol in set(self._pairs) - set(pairs):
+				self._trades.pop(symbol, None)
+				self._prices.pop(symbol, None)
+				self._event_times.pop(symbol, None)
+			for symbol in pairs:
+				self._trades.setdefault(symbol, collections.deque())
+			self._pairs = pairs
+			self._dirty &= set(pairs.itervalues())
+		reactor.callFromThread(self._subscribe, sorted(pairs))
+
+	def pop_dirty(self):
+		""" Pairs that got new events since the last call.
+		"""
+		with self._lock:
+			dirty, self._dirty = self._dirty, set()
+		return dirty
+
+	def get_price(self, pair):
+		with self._lock:
+			return self._prices.get(pair[0] + pair[1])
+
+	def get_window(self, pair, filter_threshold=1.0):
+		""" MarketWindow over the streamed trades, or None if nothing was received for the pair yet.
+		"""
+		symbol = pair[0] + pair[1]
+		with self._lock:
+			if symbol not in self._event_times:
+				return None
+			trades = list(self._trades[symbol])
+		return MarketWindow([x[1] for x in trades], filter_threshold, [x[2] for x in trades])
+
+	def _subscribe(self, symbols):
+		if self._conn_key:
+			self._manager.stop_socket(self._conn_key)
+			self._conn_key = None
+		if symbols:
+			streams = ['%s@aggTrade' % x.lower() for x in symbols] + ['%s@miniTicker' % x.lower() for x in symbols]
+			self._conn_key = self._manager.start_multiplex_socket(streams, self._on_message)
+			logging.debug('Subscribed to %s', ' '.join(symbols))
+
+	def _on_message(self, msg):
+		if self._record:
+			self._record.write(json.dumps(msg) + '\n')
+		data = msg.get('data', msg)
+		symbol = data.get('s')
+		with self._lock:
+			if symbol not in self._pairs:
+				return
+			if data.get('e') == 'aggTrade':
+				price = float(data['p'])
+				self._trades[symbol].append((data['T'], price, float(data['q'])))
+			elif data.get('e') == '24hrMiniTicker':
+				price = float(data['c'])
+			else:
+				return
+			self._prices[symbol] = price
+			self._event_times[symbol] = data['E']
+			# Drop trades older than the window, relative to exchange time.
+			trades = self._trades[symbol]
+			while trades and trades[0][0] < data['E'] - self._window_ms:
+				trades.popleft()
+			self._dirty.add(self._pairs[symbol])
+		self._wake.set()
+
+class ReplayServerProtocol(WebSocketServerProtocol):
+	""" Stand-in for the Binance stream endpoint, replays the recorded events to every client.
+	"""
+	def onOpen(self):
+		events = self.factory.events
+		if not events:
+			return
+		start_time = events[0].get('data', events[0]).get('E', 0)
+		for event in events:
+			delay = (event.get('data', event).get('E', start_time) - start_time) / 1000.0 / self.factory.speed
+			reactor.callLater(max(delay, 0), self._send, event)
+
+	def _send(self, event):
+		if self.state == WebSocketServerProtocol.STATE_OPEN:
+			self.sendMessage(json.dumps(event).encode('utf8'))
+
+def listen_replay(path, port=9443, speed=1.0):
+	""" Serve the events recorded by MarketStream(record_path=path) on a local websocket.
+
+	Returns the url to pass to MarketStream. Events keep their recorded spacing, scaled by speed.
+	"""
+	with open(path) as f:
+		events = [json.loads(line) for line in f if line.strip()]
+	factory = WebSocketServerFactory(u'ws://127.0.0.1:%d' % port)
+	factory.protocol = ReplayServerProtocol
+	factory.events = events
+	factory.speed = speed
+	reactor.callFromThread(reactor.listenTCP, port, factory, interface='127.0.0.1')
+	return 'ws://127.0.0.1:%d/' % port
@@ -1,9 +1,22 @@
 from functools import wraps as wraps
-from dal import config
+from dal import config, get_tenant
+from constants import kTelegramMaxMessageLength, kNotifyInterval, kNotifyDedupInterval, kMaxRunInterval
 from telegram.ext import Updater
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+import metrics_util
 
+import contextlib
+import itertools
+import logging
+import threading
+import time
 import traceback
 
+# Pending notifications are sent in this order.
+PRIORITY_FILL = 0
+PRIORITY_ERROR = 1
+PRIORITY_INFO = 2
+
 def bot_msg_exception(func):
 	@wraps(func)
 	def wrapped(bot, update, *args, **kwargs):
@@ -11,21 +24,31 @@ def bot_msg_exception(func):
 			return func(bot, update, *args, **kwargs)
 		except Exception as e:
 			error_str = 'Got %s: %s at:\n%s' % (type(e), e, traceback.format_exc())
-			bot.send_message(chat_id=update.message.chat_id, text=error_str)
+			bot.send_message(chat_id=update.effective_chat.id, text=error_str)
 	return wrapped
 
 def verify_owner(func):
 	@wraps(func)
 	def wrapped(bot, update, *args, **kwargs):
-		if update.message.from_user.id == config.get('owner_id', update.message.from_user.id):
+		if update.effective_user.id == config.get('owner_id', update.effective_user.id):
 			return func(bot, update, *args, **kwargs)
 		else:
 			error_str = 'Not authorized !'
-			bot.send_message(chat_id=update.message.chat_id, text=error_str)
+			bot.send_message(chat_id=update.effective_chat.id, text=error_str)
 	return wrapped
 
-def notify_user(text, when=0):
-	get_updater().job_queue.run_once(notify_user_callback, when, {'chat_id': config['chat_id'], 'text': text})
+def verify_tenant(func):
+	""" Like verify_owner but lets in every tenant, passing its dal.Tenant as the tenant keyword.
+	"""
+	@wraps(func)
+	def wrapped(bot, update, *args, **kwargs):
+		tenant = get_tenant(update.effective_user.id)
+		if tenant is not None:
+			return func(bot, update, *args, tenant=tenant, **kwargs)
+		else:
+			error_str = 'Not authorized !'
+			bot.send_message(chat_id=update.effective_chat.id, text=error_str)
+	return wrapped
 
 _glb_updater = None
 def get_updater():
@@ -35,18 +58,155 @@ def get_updater():
 
 	with open('telegram.bot.token') as f:
 		_glb_updater = Updater(token=f.read().strip())
+	# One merged message per chat per kNotifyInterval at most, well within Telegram's per chat limit.
+	_glb_updater.job_queue.run_repeating(_flush_callback, kNotifyInterval, first=0)
 	return _glb_updater
 
-def notify_user(text, when=0):
-		if 'chat_id' in config:
-			get_updater().job_queue.run_once(_notify_user_callback, when, {'chat_id': config['chat_id'], 'text': text})
-		else:
-			logging.error('No chat id in config')
+class NotificationQueue(object):
+	""" Outbound notifications of a single chat, merged into as few messages as possible.
+
+	take() returns the next message to send: the pending notifications, most important first,
+	joined up to the message length limit. Nothing is released while a hold() is active so
+	everything produced by one worker loop goes out together. A message that failed to send is
+	put back with requeue() and released again after a backoff, ack() confirms it was sent.
+	"""
+	def __init__(self, max_length=kTelegramMaxMessageLength):
+		self._max_length = max_length
+		self._pending = []
+		self._seq = itertools.count()
+		self._recent = {}
+		self._holds = 0
+		# Notifications of the last take() until ack() or requeue().
+		self._taken = []
+		self._failures = 0
+		self._retry_at = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._pending)
+
+	def put(self, text, priority=PRIORITY_INFO, key=None):
+		"""
+		key: notifications with a key are dropped if the same key was queued in the last kNotifyDedupInterval seconds.
+		"""
+		now = time.time()
+		with self._lock:
+			if key is not None:
+				if now - self._recent.get(key, 0) < kNotifyDedupInterval:
+					return False
+				self._recent = {x: y for x, y in self._recent.iteritems() if now - y < kNotifyDedupInterval}
+				self._recent[key] = now
+			# Texts over the limit are split so every piece fits in a message of its own.
+			for i in xrange(0, max(len(text), 1), self._max_length):
+				self._pending.append((priority, next(self._seq), text[i:i + self._max_length]))
+			return True
+
+	def take(self):
+		""" The next message to send or None.
+		"""
+		with self._lock:
+			if self._holds or not self._pending or time.time() < self._retry_at:
+				return None
+			self._pending.sort()
+			self._taken = []
+			length = 0
+			while self._pending:
+				text = self._pending[0][2]
+				added = len(text) + (2 if self._taken else 0)
+				if self._taken and length + added > self._max_length:
+					break
+				self._taken.append(self._pending.pop(0))
+				length += added
+			return '\n\n'.join(x[2] for x in self._taken)
+
+	def ack(self):
+		""" The message of the last take() was sent.
+		"""
+		with self._lock:
+			self._taken = []
+			self._failures = 0
 
-def _notify_user_callback(bot, job):
-    context = job.context
-    chat_id = context['chat_id']
-    text = context['text']
-    bot.send_message(chat_id=chat_id, text=text)
+	def requeue(self, delay=None):
+		""" Put the notifications of the last take() back in their place, nothing is released for delay seconds.
 
+		delay: e.g. the retry_after of Telegram, doubles from kNotifyInterval with every failure in a row by default.
+		"""
+		with self._lock:
+			self._pending.extend(self._taken)
+			self._taken = []
+			self._failures += 1
+			if delay is None:
+				delay = min(kNotifyInterval * 2 ** self._failures, kMaxRunInterval)
+			self._retry_at = time.time() + delay
 
+	@contextlib.contextmanager
+	def hold(self):
+		with self._lock:
+			self._holds += 1
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._holds -= 1
+
+_glb_queues = {}
+_glb_queues_lock = threading.Lock()
+
+def get_queue(chat_id):
+	with _glb_queues_lock:
+		if chat_id not in _glb_queues:
+			_glb_queues[chat_id] = NotificationQueue()
+		return _glb_queues[chat_id]
+
+def get_queue_depth():
+	""" Notifications waiting to be sent, over all chats.
+	"""
+	with _glb_queues_lock:
+		queues = _glb_queues.values()
+	return sum(len(x) for x in queues)
+
+metrics_util.set_gauge('notification_queue_depth', get_queue_depth)
+
+def notify_user(text, priority=PRIORITY_INFO, key=None, chat_id=None):
+	"""
+	chat_id: chat of the tenant to notify, the owner's by default.
+	"""
+	if chat_id is None:
+		chat_id = config.get('chat_id')
+	if chat_id is not None:
+		get_queue(chat_id).put(text, priority, key)
+	else:
+		logging.error('No chat id in config')
+
+@contextlib.contextmanager
+def notification_batch(chat_ids=None):
+	""" Hold back notifications until the block ends so they are merged into one message.
+
+	chat_ids: the chats to hold, the owner's by default.
+	"""
+	if chat_ids is None:
+		chat_ids = [config['chat_id']] if 'chat_id' in config else []
+	with contextlib.nested(*[get_queue(x).hold() for x in set(chat_ids)]):
+		yield
+
+def _flush_callback(bot, job):
+	with _glb_queues_lock:
+		queues = _glb_queues.items()
+	for chat_id, queue in queues:
+		text = queue.take()
+		if text is None:
+			continue
+		try:
+			bot.send_message(chat_id=chat_id, text=text)
+		except (BadRequest, Unauthorized) as e:
+			# Sending it again would fail the same way, e.g. the user blocked the bot.
+			logging.error('Dropped a notification to %s: %s', chat_id, e)
+			queue.ack()
+		except RetryAfter as e:
+			logging.warning('Notifications to %s are throttled for %s seconds', chat_id, e.retry_after)
+			queue.requeue(e.retry_after)
+		except Exception as e:
+			logging.error('Failed to notify %s: %s', chat_id, e)
+			queue.requeue()
+		else:
+			queue.ack()
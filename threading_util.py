@@ -1,12 +1,105 @@
+import contextlib as _contextlib
 import threading as _threading
+import time as _time
 from functools import wraps as _wraps
 
-_glb_lock = _threading.Lock()
+import metrics_util as _metrics_util
+
+class RWLock(object):
+	""" Shared reader / exclusive writer lock.
+
+	Both sides are reentrant and the writer may also take the read side, but a reader cannot upgrade.
+	Waiting writers block new readers so a stream of handlers cannot starve the worker commits.
+	The time every first acquisition waited is observed in the lock_wait_seconds metric.
+	"""
+	def __init__(self, name='lock'):
+		self._name = name
+		self._cond = _threading.Condition(_threading.Lock())
+		self._readers = {}
+		self._writer = None
+		self._writer_depth = 0
+		self._writers_waiting = 0
+
+	def acquire_read(self):
+		me = _threading.current_thread()
+		started = _time.time()
+		with self._cond:
+			if self._writer is me or me in self._readers:
+				self._readers[me] = self._readers.get(me, 0) + 1
+				return
+			while self._writer is not None or self._writers_waiting:
+				self._cond.wait()
+			self._readers[me] = 1
+		_metrics_util.observe('lock_wait_seconds', _time.time() - started, lock=self._name, mode='read')
+
+	def release_read(self):
+		me = _threading.current_thread()
+		with self._cond:
+			self._readers[me] -= 1
+			if not self._readers[me]:
+				del self._readers[me]
+				if not self._readers:
+					self._cond.notify_all()
+
+	def acquire_write(self):
+		me = _threading.current_thread()
+		started = _time.time()
+		with self._cond:
+			if self._writer is me:
+				self._writer_depth += 1
+				return
+			if me in self._readers:
+				raise RuntimeError('Cannot upgrade a read lock to a write lock')
+			self._writers_waiting += 1
+			try:
+				while self._writer is not None or self._readers:
+					self._cond.wait()
+			finally:
+				self._writers_waiting -= 1
+			self._writer = me
+			self._writer_depth = 1
+		_metrics_util.observe('lock_wait_seconds', _time.time() - started, lock=self._name, mode='write')
+
+	def release_write(self):
+		with self._cond:
+			self._writer_depth -= 1
+			if not self._writer_depth:
+				self._writer = None
+				self._cond.notify_all()
+
+	@_contextlib.contextmanager
+	def read(self):
+		self.acquire_read()
+		try:
+			yield
+		finally:
+			self.release_read()
+
+	@_contextlib.contextmanager
+	def write(self):
+		self.acquire_write()
+		try:
+			yield
+		finally:
+			self.release_write()
+
+# Guards trades_db, config and the trigger index. Never do network I/O while holding it.
+state_lock = RWLock('state')
 
 def requires_lock(func):
+	""" Run func holding the write side of state_lock.
+	"""
 	@_wraps(func)
 	def wrapped(*args, **kwargs):
-		with _glb_lock:
+		with state_lock.write():
 			return func(*args, **kwargs)
 	return wrapped
 
+def requires_read_lock(func):
+	""" Run func holding the read side of state_lock.
+	"""
+	@_wraps(func)
+	def wrapped(*args, **kwargs):
+		with state_lock.read():
+			return func(*args, **kwargs)
+	return wrapped
@@ -0,0 +1,135 @@
+import numpy as np
+
+from constants import TRADE_TYPE
+
+# Codes of the type column, trades of any other type get -1.
+_TYPE_CODES = {x: i for i, x in enumerate(TRADE_TYPE.ALL)}
+_BUY_BELOW = _TYPE_CODES[TRADE_TYPE.BUY_BELOW_AT_MARKET]
+_SELL_ABOVE = _TYPE_CODES[TRADE_TYPE.SELL_ABOVE_AT_MARKET]
+_SELL_BELOW = _TYPE_CODES[TRADE_TYPE.SELL_BELOW_AT_MARKET]
+_TRAILING = _TYPE_CODES[TRADE_TYPE.TRAILING_STOP_LOSS]
+_ALERT_ABOVE = _TYPE_CODES[TRADE_TYPE.ALERT_ABOVE]
+_ALERT_BELOW = _TYPE_CODES[TRADE_TYPE.ALERT_BELOW]
+
+class TradeBook(object):
+	""" The open trades as columns (pair, type, threshold, delta, quantity), evaluated in one numpy pass.
+
+	Rows are kept packed, a removed row is replaced by the last one. Like TriggerIndex it only holds
+	the numbers the triggers need, the trades themselves stay in trades_db.
+	"""
+	def __init__(self, items=(), capacity=64):
+		"""
+		items: (key, trade) pairs to load, e.g. trades_db.iteritems().
+		"""
+		self._size = 0
+		self._keys = []
+		self._rows = {}
+		self._pair_codes = {}
+		self._pair_column = np.zeros(capacity, dtype=np.int32)
+		self._type_column = np.zeros(capacity, dtype=np.int8)
+		self._thresholds = np.zeros(capacity, dtype=np.float64)
+		self._deltas = np.zeros(capacity, dtype=np.float64)
+		self._quantities = np.zeros(capacity, dtype=np.float64)
+		for key, trade in items:
+			self.add(key, trade)
+
+	def __contains__(self, key):
+		return key in self._rows
+
+	def __len__(self):
+		return self._size
+
+	def add(self, key, trade):
+		if not isinstance(trade, dict):
+			return
+		if key in self._rows:
+			self.remove(key)
+		if self._size == len(self._thresholds):
+			self._grow()
+		pair = tuple(trade['pair'])
+		if pair not in self._pair_codes:
+			self._pair_codes[pair] = len(self._pair_codes)
+		row = self._size
+		self._pair_column[row] = self._pair_codes[pair]
+		self._type_column[row] = _TYPE_CODES.get(trade['type'], -1)
+		self._thresholds[row] = trade['threshold']
+		self._deltas[row] = trade.get('delta', 0)
+		self._quantities[row] = trade.get('quantity', 0)
+		self._keys.append(key)
+		self._rows[key] = row
+		self._size += 1
+
+	def remove(self, key):
+		if key not in self._rows:
+			return
+		row = self._rows.pop(key)
+		last = self._size - 1
+		if row != last:
+			for column in self._columns():
+				column[row] = column[last]
+			self._keys[row] = self._keys[last]
+			self._rows[self._keys[row]] = row
+		self._keys.pop()
+		self._size -= 1
+
+	def update(self, key, trade):
+		self.add(key, trade)
+
+	def evaluate(self, markets, keys=None):
+		""" Trailing threshold moves and fired trades on the given pairs, returns (moved, fired, unknown).
+
+		markets: {pair: (price, high, low, free, min_q, price_step)}, high and low being the extremes
+		of the recent window and free the available balance of the pair's base asset.
+		keys: only evaluate these trades, e.g. the candidates of TriggerIndex.fired and trailing, all by default.
+
+		moved: [(key, new threshold)] of the trailing stops that moved by more than a price step.
+		fired: [(key, quantity)] of the trades whose condition holds on the (moved) threshold. The
+		quantity is what to trade, None for alerts.
+		unknown: keys of the trades on these pairs with an unrecognized type.
+		"""
+		if keys is None:
+			rows = np.arange(self._size)
+		else:
+			rows = np.fromiter((self._rows[x] for x in keys if x in self._rows), dtype=np.intp)
+		if not len(rows) or not markets:
+			return [], [], []
+		# Per pair inputs, NaN for the pairs not being evaluated.
+		inputs = np.full((len(self._pair_codes), 6), np.nan)
+		for pair, values in markets.iteritems():
+			if pair in self._pair_codes:
+				inputs[self._pair_codes[pair]] = values
+		price, high, low, free, min_q, price_step = inputs[self._pair_column[rows]].T
+		types = self._type_column[rows]
+		thresholds = self._thresholds[rows]
+		quantities = self._quantities[rows]
+		active = ~np.isnan(price)
+
+		# Update trails
+		trailing = active & (types == _TRAILING)
+		new_thresholds = np.where(trailing, np.fmax(thresholds, (1 - self._deltas[rows]) * high), thresholds)
+		moved = trailing & (new_thresholds - thresholds > price_step)
+		thresholds = np.where(moved, new_thresholds, thresholds)
+
+		viable_q = np.fmin(free, quantities)
+		sellable = viable_q >= min_q
+		below = high < thresholds
+		buys = (types == _BUY_BELOW) & below
+		sells = (((types == _SELL_ABOVE) & (low > thresholds))
+				| (((types == _SELL_BELOW) | (types == _TRAILING)) & below)) & sellable
+		alerts = ((types == _ALERT_ABOVE) & (price > thresholds)) | ((types == _ALERT_BELOW) & (price < thresholds))
+		# NaN inputs compare False, so inactive rows never fire.
+		traded = np.where(buys, quantities, viable_q)
+
+		keys = self._keys
+		moved = [(keys[rows[i]], float(thresholds[i])) for i in np.flatnonzero(moved)]
+		fired = [(keys[rows[i]], float(traded[i])) for i in np.flatnonzero(buys | sells)]
+		fired += [(keys[rows[i]], None) for i in np.flatnonzero(alerts)]
+		unknown = [keys[rows[i]] for i in np.flatnonzero(active & (types == -1))]
+		return moved, fired, unknown
+
+	def _columns(self):
+		return (self._pair_column, self._type_column, self._thresholds, self._deltas, self._quantities)
+
+	def _grow(self):
+		self._pair_column, self._type_column, self._thresholds, self._deltas, self._quantities = [
+				np.concatenate((column, np.zeros_like(column))) for column in self._columns()]
@@ -0,0 +1,124 @@
+import bisect
+
+from constants import TRADE_TYPE
+
+# Trades that fire when the price rises above their threshold, all other types fire when it drops below.
+_ABOVE_TYPES = (TRADE_TYPE.SELL_ABOVE_AT_MARKET, TRADE_TYPE.ALERT_ABOVE)
+
+class _SortedThresholds(object):
+	""" Keys sorted by their threshold, kept in two parallel lists so thresholds can be bisected directly.
+	"""
+	def __init__(self):
+		self.thresholds = []
+		self.keys = []
+
+	def __len__(self):
+		return len(self.keys)
+
+	def add(self, threshold, key):
+		i = bisect.bisect_right(self.thresholds, threshold)
+		self.thresholds.insert(i, threshold)
+		self.keys.insert(i, key)
+
+	def remove(self, threshold, key):
+		i = bisect.bisect_left(self.thresholds, threshold)
+		while self.keys[i] != key:
+			i += 1
+		del self.thresholds[i]
+		del self.keys[i]
+
+	def below(self, price):
+		""" Keys with a threshold strictly below price.
+		"""
+		return self.keys[:bisect.bisect_left(self.thresholds, price)]
+
+	def above(self, price):
+		""" Keys with a threshold strictly above price.
+		"""
+		return self.keys[bisect.bisect_right(self.thresholds, price):]
+
+	def nearest(self, price):
+		""" The threshold closest to price, None if empty.
+		"""
+		i = bisect.bisect_left(self.thresholds, price)
+		neighbours = self.thresholds[max(i - 1, 0):i + 1]
+		return min(neighbours, key=lambda x: abs(x - price)) if neighbours else None
+
+class TriggerIndex(object):
+	""" Open trades per pair, sorted by threshold and split by the direction they fire in.
+
+	Bisects the trades of a window down to the ones that may have fired, TradeBook then evaluates only
+	those. Only holds keys and thresholds, the trades themselves stay in trades_db.
+	"""
+	def __init__(self, items=()):
+		"""
+		items: (key, trade) pairs to index, e.g. trades_db.iteritems().
+		"""
+		self._pairs = {}
+		self._trailing = {}
+		self._entries = {}
+		for key, trade in items:
+			self.add(key, trade)
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+	def add(self, key, trade):
+		if not isinstance(trade, dict):
+			return
+		pair = tuple(trade['pair'])
+		direction = 'above' if trade['type'] in _ABOVE_TYPES else 'below'
+		if pair not in self._pairs:
+			self._pairs[pair] = {'above': _SortedThresholds(), 'below': _SortedThresholds()}
+		self._pairs[pair][direction].add(trade['threshold'], key)
+		if trade['type'] == TRADE_TYPE.TRAILING_STOP_LOSS:
+			self._trailing.setdefault(pair, set()).add(key)
+		self._entries[key] = (pair, direction, trade['threshold'])
+
+	def remove(self, key):
+		if key not in self._entries:
+			return
+		pair, direction, threshold = self._entries.pop(key)
+		self._pairs[pair][direction].remove(threshold, key)
+		self._trailing.get(pair, set()).discard(key)
+		if not self._pairs[pair]['above'] and not self._pairs[pair]['below']:
+			del self._pairs[pair]
+			self._trailing.pop(pair, None)
+
+	def update(self, key, trade):
+		""" Move the trade to its new threshold, e.g. after a trailing stop moved.
+		"""
+		self.remove(key)
+		self.add(key, trade)
+
+	def get_pairs(self):
+		return set(self._pairs)
+
+	def trailing(self, pair):
+		""" Keys of the trailing stops on pair, their thresholds are updated on every window.
+		"""
+		return set(self._trailing.get(pair, ()))
+
+	def fired(self, pair, high, low):
+		""" Keys of the trades on pair that may have fired.
+
+		high: highest price that counts for the above direction.
+		low: lowest price that counts for the below direction.
+
+		Every trade that fired is returned, callers check the exact per type condition on these only.
+		"""
+		if pair not in self._pairs:
+			return []
+		return self._pairs[pair]['above'].below(high) + self._pairs[pair]['below'].above(low)
+
+	def nearest(self, pair, price):
+		""" The threshold on pair closest to price, None if the pair has no trades.
+		"""
+		if pair not in self._pairs:
+			return None
+		thresholds = [x.nearest(price) for x in self._pairs[pair].itervalues()]
+		thresholds = [x for x in thresholds if x is not None]
+		return min(thresholds, key=lambda x: abs(x - price)) if thresholds else None
@@ -0,0 +1,169 @@
+import math
+
+import numpy as np
+
+from constants import kTradeBufferSize
+
+def parse_agg_trades(trades):
+	""" Columns of an aggTrades response: (prices, quantities, times) as numpy arrays.
+	"""
+	prices = np.array([trade['p'] for trade in trades], dtype=np.float64)
+	quantities = np.array([trade['q'] for trade in trades], dtype=np.float64)
+	times = np.array([trade['T'] for trade in trades], dtype=np.int64)
+	return prices, quantities, times
+
+def filter_indices(prices, threshold, center=None):
+	""" Indices of the threshold fraction of the prices closest to center (the median by default).
+
+	Uses a partition instead of a full sort, the kept indices are in no particular order.
+	"""
+	num_keep = int(math.ceil(threshold * len(prices)))
+	if num_keep >= len(prices):
+		return np.arange(len(prices))
+	if center is None:
+		center = np.median(prices)
+	return np.argpartition(np.abs(prices - center), num_keep - 1)[:num_keep]
+
+def filter_prices(prices, threshold):
+	""" Keep threshold percent of the prices based on distance from the median.
+	"""
+	prices = np.asarray(prices, dtype=np.float64)
+	return prices[filter_indices(prices, threshold)]
+
+class MarketWindow(object):
+	""" Statistics of the trades of a single pair over a recent time window.
+
+	Built once per pair per loop so every trade on that pair reads the same numbers. All of them
+	are computed up front from numpy arrays; min() and max() are the extremes after dropping the
+	outliers, raw_min() and raw_max() before. Getters return None when the window has no trades.
+	"""
+	def __init__(self, prices, filter_threshold=1.0, quantities=None):
+		"""
+		prices: trade prices in time order.
+		quantities: trade quantities, needed for vwap().
+		"""
+		prices = np.asarray(prices, dtype=np.float64)
+		self._len = 0
+		self.last = self._median = self._vwap = None
+		self._min = self._max = self._raw_min = self._raw_max = None
+		if not len(prices):
+			return
+		self.last = float(prices[-1])
+		self._median = float(np.median(prices))
+		self._raw_min = float(prices.min())
+		self._raw_max = float(prices.max())
+		if quantities is not None and len(quantities):
+			quantities = np.asarray(quantities, dtype=np.float64)
+			volume = quantities.sum()
+			if volume > 0:
+				self._vwap = float(np.dot(prices, quantities) / volume)
+		# Filter out outliers
+		if filter_threshold < 1.0:
+			prices = prices[filter_indices(prices, filter_threshold, self._median)]
+		self._len = len(prices)
+		self._min = float(prices.min())
+		self._max = float(prices.max())
+
+	def __len__(self):
+		return self._len
+
+	def min(self):
+		return self._min
+
+	def max(self):
+		return self._max
+
+	def raw_min(self):
+		return self._raw_min
+
+	def raw_max(self):
+		return self._raw_max
+
+	def median(self):
+		return self._median
+
+	def vwap(self):
+		return self._vwap
+
+class TradeBuffer(object):
+	""" Fixed capacity ring buffer of the recent aggregate trades of one pair, oldest first.
+
+	Stored as flat numpy columns, so memory per pair is bounded by capacity no matter how busy it is.
+	"""
+	def __init__(self, capacity=kTradeBufferSize):
+		self._capacity = capacity
+		self._ids = np.zeros(capacity, dtype=np.int64)
+		self._times = np.zeros(capacity, dtype=np.int64)
+		self._prices = np.zeros(capacity, dtype=np.float64)
+		self._quantities = np.zeros(capacity, dtype=np.float64)
+		self._start = 0
+		self._size = 0
+
+	def __len__(self):
+		return self._size
+
+	def __getstate__(self):
+		# Only the buffered trades oldest first, not the whole capacity.
+		positions = (self._start + np.arange(self._size)) % self._capacity
+		return self._capacity, self._ids[positions], self._times[positions], self._prices[positions], self._quantities[positions]
+
+	def __setstate__(self, state):
+		capacity, ids, times, prices, quantities = state
+		self.__init__(capacity)
+		self._size = len(ids)
+		self._ids[:self._size] = ids
+		self._times[:self._size] = times
+		self._prices[:self._size] = prices
+		self._quantities[:self._size] = quantities
+
+	@property
+	def last_id(self):
+		""" aggTrades id of the newest trade, the cursor for the next download.
+		"""
+		if not self._size:
+			return None
+		return int(self._ids[(self._start + self._size - 1) % self._capacity])
+
+	@property
+	def last_time(self):
+		if not self._size:
+			return None
+		return int(self._times[(self._start + self._size - 1) % self._capacity])
+
+	def extend(self, trades):
+		""" Append an aggTrades response, trades already in the buffer are skipped.
+		"""
+		if not trades:
+			return
+		ids = np.array([trade['a'] for trade in trades], dtype=np.int64)
+		prices, quantities, times = parse_agg_trades(trades)
+		if self._size:
+			new = ids > self.last_id
+			ids, prices, quantities, times = ids[new], prices[new], quantities[new], times[new]
+		# Only the newest capacity trades can survive.
+		ids, prices, quantities, times = ids[-self._capacity:], prices[-self._capacity:], quantities[-self._capacity:], times[-self._capacity:]
+		n = len(ids)
+		if not n:
+			return
+		positions = (self._start + self._size + np.arange(n)) % self._capacity
+		self._ids[positions] = ids
+		self._times[positions] = times
+		self._prices[positions] = prices
+		self._quantities[positions] = quantities
+		overflow = max(self._size + n - self._capacity, 0)
+		self._start = (self._start + overflow) % self._capacity
+		self._size = min(self._size + n, self._capacity)
+
+	def history(self):
+		""" Copies of the (times, prices) columns, oldest first.
+		"""
+		positions = (self._start + np.arange(self._size)) % self._capacity
+		return self._times[positions], self._prices[positions]
+
+	def window(self, start_time, filter_threshold=1.0):
+		""" MarketWindow over the buffered trades at or after start_time (ms).
+		"""
+		positions = (self._start + np.arange(self._size)) % self._capacity
+		first = np.searchsorted(self._times[positions], start_time)
+		positions = positions[first:]
+		return MarketWindow(self._prices[positions], filter_threshold, self._quantities[positions])